@@ -206,6 +206,39 @@ function httpGetAsync(theUrl, callback)
     xmlHttp.send(null);
 }
 
+// Calls back with the complete lines received so far while the response
+// is streamed
+function httpGetLines(theUrl, callback)
+{
+    var xmlHttp = new XMLHttpRequest();
+    var parsed = 0;
+    var parse = function() {
+        var end = xmlHttp.responseText.lastIndexOf("\n") + 1;
+        if (xmlHttp.status == 200 && end > parsed) {
+            callback(xmlHttp.responseText.slice(parsed, end));
+            parsed = end;
+        }
+    }
+    xmlHttp.onprogress = parse;
+    xmlHttp.onreadystatechange = function() { 
+        if (xmlHttp.readyState == 4)
+            parse();
+    }
+    xmlHttp.open("GET", theUrl, true); // true for asynchronous 
+    xmlHttp.send(null);
+}
+
+function httpPostAsync(theUrl, body, callback)
+{
+    var xmlHttp = new XMLHttpRequest();
+    xmlHttp.onreadystatechange = function() { 
+        if (xmlHttp.readyState == 4 && xmlHttp.status == 200)
+            callback(xmlHttp.responseText);
+    }
+    xmlHttp.open("POST", theUrl, true); // true for asynchronous 
+    xmlHttp.send(body);
+}
+
 function srch(text)
 {
 	search_text = text;
@@ -298,8 +331,22 @@ function newNetwork() {
 			node = findNode(nodeid);
 			rows = node.label.split("\n");
 			if (findRow(rows, "Role") == "") {
+				// Expand the other selected nodes that are not expanded in the same request
+				expand = [nodeid];
+				for (id of network.getSelectedNodes()) {
+					other = findNode(id);
+					if (id != nodeid && findRow(other.label.split("\n"), "Role") == "") {
+						other.label = " \n\n";
+						expand.push(id);
+					}
+				}
 				node.label = " \n\n";
-				httpGetAsync("entity/" + nodeid, parse_relations_and_move(nodeid));
+				if (expand.length == 1) {
+					httpGetAsync("entity/" + nodeid, parse_relations_and_move(nodeid));
+				}
+				else {
+					httpPostAsync("entities", expand.join("\n"), parse_relations_and_move(nodeid));
+				}
 			}
 			else {
 				node.shape = "dot";
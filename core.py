@@ -30,13 +30,29 @@ SOFTWARE.
 import sqlite3
 import datetime
 import os
+import sys
+import re
 import json
+import collections
 import webbrowser
 import random
 import threading
 import http.server
 import socketserver
-import http.client
+import signal
+import queue
+import time
+import hashlib
+import gzip
+import zlib
+import lzma
+import mmap
+import tempfile
+import mimetypes
+import email.utils
+import urllib.parse
+import array
+import bisect
 
 __author__ = "Marcus T. Andersson"
 __copyright__ = "Copyright 2020, Marcus T. Andersson"
@@ -44,14 +60,18 @@ __credits__ = ["Marcus T. Andersson"]
 __license__ = "MIT"
 __version__ = "2"
 __maintainer__ = "Marcus T. Andersson"
-__implements__ = ["R1/v1", "R2/v1"]
+__implements__ = ["R1/v1", "R2/v1", "R6/v1"]
 
 dbfile = 'data.sqlite3'
 newdb = False
 
+# Prepared statements are cached per connection by their SQL text. Every
+# relation has its own insert, trigger and lookup statements, which is
+# more than the default of 128 holds.
+cached_statements = 1024
+
 # Open database in autocommit mode by setting isolation_level to None.
-conn = sqlite3.connect(dbfile, isolation_level=None)
-webconn = None # Opens in webserver thread
+conn = sqlite3.connect(dbfile, isolation_level=None, cached_statements=cached_statements)
 
 # Set journal mode to WAL.
 conn.execute('pragma journal_mode=wal')
@@ -64,11 +84,32 @@ for row in c:
 	tables += [row[0]]
 c.close()
 
+# Fetch existing views (current state views of databases created before
+# the current state was materialized into tables)
+c = conn.cursor()
+c.execute("SELECT name FROM sqlite_master WHERE type='view'")
+views = []
+for row in c:
+	views += [row[0]]
+c.close()
+
+# Fetch existing indexes
+c = conn.cursor()
+c.execute("SELECT name FROM sqlite_master WHERE type='index'")
+indexes = []
+for row in c:
+	indexes += [row[0]]
+c.close()
+
 # JSON Encoder
 jenc = json.JSONEncoder()
 
-# Mapping from designation letter to sqlite3 column type
-dbtype = {"S": "TEXT", "T": "TEXT", "B": "BLOB", "I": "INTEGER", "R": "REAL", "E": "TEXT"}
+class PiiError(Exception):
+	pass
+
+# Mapping from designation letter to sqlite3 column type. Entities are
+# stored as the integer id of their UUID in the Entity table.
+dbtype = {"S": "TEXT", "T": "TEXT", "B": "BLOB", "I": "INTEGER", "R": "REAL", "E": "INTEGER"}
 
 ###
 ### Basic database schema creation
@@ -79,12 +120,30 @@ def unary_rel(name):
 	statements = []
 	if name not in tables:
 		statements += [(f"CREATE TABLE IF NOT EXISTS {name} (t INTEGER PRIMARY KEY, l {left_type}, a INTEGER)", ())]
-		#statements += [(f"CREATE INDEX IF NOT EXISTS {name}_l ON {name} (l)", ())]
-		#statements += [(f"CREATE INDEX IF NOT EXISTS {name}_a ON {name} (a)", ())]
-		statements += [(f"CREATE VIEW IF NOT EXISTS {name}cn AS select l, t from (select l, t, a from (select l, t, a from {name} order by t desc) group by l) where a=1", ())]
+		statements += unary_state(name)
+		statements += unary_index(name)
+		statements += change_trigger(name, False)
 		tables += [name]
 	return statements
 
+# The current state of a relation is kept in tables named after the
+# cardinality (cn, cnn, cn1, c1n, c11x) that are updated by triggers when
+# rows are appended to the relation. Lookups then only depend on the
+# amount of live data and not on the length of the history.
+
+def unary_state(name):
+	left_type = dbtype[name[-1:]]
+	statements = []
+	statements += [(f"CREATE TABLE IF NOT EXISTS {name}cn (l {left_type}, t INTEGER)", ())]
+	statements += [(f"CREATE UNIQUE INDEX IF NOT EXISTS {name}cn_l ON {name}cn (l)", ())]
+	statements += [(f"""CREATE TRIGGER IF NOT EXISTS {name}_state AFTER INSERT ON {name} BEGIN
+		DELETE FROM {name}cn WHERE l = new.l;
+		INSERT INTO {name}cn (l, t) SELECT new.l, new.t WHERE new.a = 1;
+		END""", ())]
+	# Populate from history when migrating an existing relation
+	statements += [(f"INSERT OR REPLACE INTO {name}cn (l, t) select l, t from (select l, max(t) as t, a from {name} group by l) where a=1", ())]
+	return statements
+
 def binary_rel(name):
 	global tables
 	left_type = dbtype[name[-2:-1]]
@@ -92,17 +151,265 @@ def binary_rel(name):
 	statements = []
 	if name not in tables:
 		statements += [(f"CREATE TABLE IF NOT EXISTS {name} (t INTEGER PRIMARY KEY, l {left_type}, r {right_type}, a INTEGER)", ())]
-		#statements += [(f"CREATE INDEX IF NOT EXISTS {name}_l ON {name} (l)", ())]
-		#statements += [(f"CREATE INDEX IF NOT EXISTS {name}_r ON {name} (r)", ())]
-		#statements += [(f"CREATE INDEX IF NOT EXISTS {name}_a ON {name} (a)", ())]
-		statements += [(f"CREATE VIEW IF NOT EXISTS {name}cnn AS select l, r, t from (select l, r, t, a from (select l, r, t, a from {name} order by t desc) group by l, r) where a=1", ())]
-		statements += [(f"CREATE VIEW IF NOT EXISTS {name}cn1 AS select l, r, t from (select l, r, t from {name}cnn order by t desc) group by l", ())]
-		statements += [(f"CREATE VIEW IF NOT EXISTS {name}c1n AS select l, r, t from (select l, r, t from {name}cnn order by t desc) group by r", ())]
-		statements += [(f"CREATE VIEW IF NOT EXISTS {name}c11x AS select l, r, t from {name}c1n INTERSECT select l, r, t from {name}cn1", ())]
-		statements += [(f"CREATE VIEW IF NOT EXISTS {name}c11 AS select l, r, t from {name}c11x UNION select l, r, t from (select l, r, t from {name}cn1 where r not in (select r from {name}c11x) order by t) group by r UNION select l, r, t from (select l, r, t from {name}c1n where l not in (select l from {name}c11x) order by t) group by l", ())]
+		statements += binary_state(name)
+		statements += binary_index(name)
+		statements += change_trigger(name, True)
 		tables += [name]
 	return statements
 
+def binary_state(name):
+	if name[-1:] == "B":
+		return blob_state(name)
+	left_type = dbtype[name[-2:-1]]
+	right_type = dbtype[name[-1:]]
+	statements = []
+	for card in ["cnn", "cn1", "c1n", "c11x"]:
+		statements += [(f"CREATE TABLE IF NOT EXISTS {name}{card} (l {left_type}, r {right_type}, t INTEGER)", ())]
+	statements += [(f"CREATE UNIQUE INDEX IF NOT EXISTS {name}cnn_lr ON {name}cnn (l, r)", ())]
+	statements += [(f"CREATE UNIQUE INDEX IF NOT EXISTS {name}cn1_l ON {name}cn1 (l)", ())]
+	statements += [(f"CREATE UNIQUE INDEX IF NOT EXISTS {name}c1n_r ON {name}c1n (r)", ())]
+	# Only the rows for new.l and new.r can change when a row is appended.
+	statements += [(f"""CREATE TRIGGER IF NOT EXISTS {name}_state AFTER INSERT ON {name} BEGIN
+		DELETE FROM {name}cnn WHERE l = new.l AND r = new.r;
+		INSERT INTO {name}cnn (l, r, t) SELECT new.l, new.r, new.t WHERE new.a = 1;
+		DELETE FROM {name}cn1 WHERE l = new.l;
+		INSERT INTO {name}cn1 (l, r, t) SELECT l, r, t FROM {name}cnn WHERE l = new.l ORDER BY t DESC LIMIT 1;
+		DELETE FROM {name}c1n WHERE r = new.r;
+		INSERT INTO {name}c1n (l, r, t) SELECT l, r, t FROM {name}cnn WHERE r = new.r ORDER BY t DESC LIMIT 1;
+		DELETE FROM {name}c11x WHERE l = new.l OR r = new.r;
+		INSERT INTO {name}c11x (l, r, t) SELECT lft.l, lft.r, lft.t FROM {name}cn1 lft
+			JOIN {name}c1n rght ON (lft.l = rght.l AND lft.r = rght.r AND lft.t = rght.t)
+			WHERE lft.l = new.l OR lft.r = new.r;
+		END""", ())]
+	# Populate from history when migrating an existing relation
+	statements += [(f"INSERT OR REPLACE INTO {name}cnn (l, r, t) select l, r, t from (select l, r, max(t) as t, a from {name} group by l, r) where a=1", ())]
+	statements += [(f"INSERT OR REPLACE INTO {name}cn1 (l, r, t) select l, r, max(t) from {name}cnn group by l", ())]
+	statements += [(f"INSERT OR REPLACE INTO {name}c1n (l, r, t) select l, r, max(t) from {name}cnn group by r", ())]
+	statements += [(f"DELETE FROM {name}c11x", ())]
+	statements += [(f"INSERT INTO {name}c11x (l, r, t) select lft.l, lft.r, lft.t from {name}cn1 lft join {name}c1n rght on (lft.l = rght.l and lft.r = rght.r and lft.t = rght.t)", ())]
+	# c11 pairs up what remains after c11x, which is cheap now that it reads the state tables.
+	statements += [(f"CREATE VIEW IF NOT EXISTS {name}c11 AS select l, r, t from {name}c11x UNION select l, r, t from (select l, r, t from {name}cn1 where r not in (select r from {name}c11x) order by t) group by r UNION select l, r, t from (select l, r, t from {name}c1n where l not in (select l from {name}c11x) order by t) group by l", ())]
+	return statements
+
+# The state tables of a relation with B values only refer to the rows of
+# the relation by t, so the values are stored once. The values are read
+# from the relation with Relation.value(). Nothing looks up entities by
+# B values, so there is no state by value (c1n, c11x and c11).
+def blob_state(name):
+	left_type = dbtype[name[-2:-1]]
+	statements = []
+	for card in ["cnn", "cn1"]:
+		statements += [(f"CREATE TABLE IF NOT EXISTS {name}{card} (l {left_type}, t INTEGER)", ())]
+	statements += [(f"CREATE UNIQUE INDEX IF NOT EXISTS {name}cnn_lt ON {name}cnn (l, t)", ())]
+	statements += [(f"CREATE UNIQUE INDEX IF NOT EXISTS {name}cn1_l ON {name}cn1 (l)", ())]
+	# The rows of new.l with the same value are found from the history of new.l
+	statements += [(f"""CREATE TRIGGER IF NOT EXISTS {name}_state AFTER INSERT ON {name} BEGIN
+		DELETE FROM {name}cnn WHERE l = new.l AND t IN (SELECT t FROM {name} WHERE l = new.l AND r = new.r);
+		INSERT INTO {name}cnn (l, t) SELECT new.l, new.t WHERE new.a = 1;
+		DELETE FROM {name}cn1 WHERE l = new.l;
+		INSERT INTO {name}cn1 (l, t) SELECT l, t FROM {name}cnn WHERE l = new.l ORDER BY t DESC LIMIT 1;
+		END""", ())]
+	# Populate from history when migrating an existing relation
+	statements += [(f"INSERT OR REPLACE INTO {name}cnn (l, t) select l, t from (select l, max(t) as t, a from {name} group by l, r) where a=1", ())]
+	statements += [(f"INSERT OR REPLACE INTO {name}cn1 (l, t) select l, max(t) from {name}cnn group by l", ())]
+	return statements
+
+# Indexes are shaped after the access patterns. History is read per l or
+# per r in time order, the triggers pick the latest row per l or r in the
+# current state and lookups read the other column (covering index).
+
+def unary_index(name):
+	statements = []
+	statements += [(f"CREATE INDEX IF NOT EXISTS {name}_lt ON {name} (l, t)", ())]
+	statements += [(f"CREATE INDEX IF NOT EXISTS {name}_a1 ON {name} (l) WHERE a = 1", ())]
+	return statements
+
+# B values are never looked up, so they are not copied into indexes either
+def binary_index(name):
+	statements = []
+	statements += [(f"CREATE INDEX IF NOT EXISTS {name}_lt ON {name} (l, t)", ())]
+	if name[-1:] == "B":
+		return statements
+	statements += [(f"CREATE INDEX IF NOT EXISTS {name}_rt ON {name} (r, t)", ())]
+	statements += [(f"CREATE INDEX IF NOT EXISTS {name}_lrt ON {name} (l, r, t)", ())]
+	statements += [(f"CREATE INDEX IF NOT EXISTS {name}_a1 ON {name} (r, l) WHERE a = 1", ())]
+	statements += [(f"CREATE INDEX IF NOT EXISTS {name}cnn_ltr ON {name}cnn (l, t, r)", ())]
+	statements += [(f"CREATE INDEX IF NOT EXISTS {name}cnn_rtl ON {name}cnn (r, t, l)", ())]
+	statements += [(f"CREATE INDEX IF NOT EXISTS {name}cn1_rl ON {name}cn1 (r, l)", ())]
+	statements += [(f"CREATE INDEX IF NOT EXISTS {name}c1n_lr ON {name}c1n (l, r)", ())]
+	statements += [(f"CREATE INDEX IF NOT EXISTS {name}c11x_lr ON {name}c11x (l, r)", ())]
+	statements += [(f"CREATE INDEX IF NOT EXISTS {name}c11x_rl ON {name}c11x (r, l)", ())]
+	return statements
+
+# Databases created before the current state was materialized have views
+# with the same names. Replace them with tables populated from history.
+# The state tables of relations with B values used to have copies of the
+# values.
+def migrate_state():
+	global views
+	statements = []
+	for name in tables:
+		if name[-1:] == "B" and f"{name}c1n" in tables:
+			statements += [(f"DROP TRIGGER IF EXISTS {name}_state", ())]
+			statements += [(f"DROP VIEW IF EXISTS {name}c11", ())]
+			for card in ["c11x", "c1n", "cn1", "cnn"]:
+				statements += [(f"DROP TABLE IF EXISTS {name}{card}", ())]
+			statements += blob_state(name)
+		elif f"{name}cnn" in views:
+			for card in ["c11", "c11x", "c1n", "cn1", "cnn"]:
+				statements += [(f"DROP VIEW IF EXISTS {name}{card}", ())]
+			statements += binary_state(name)
+		elif f"{name}cn" in views:
+			statements += [(f"DROP VIEW IF EXISTS {name}cn", ())]
+			statements += unary_state(name)
+	views = []
+	return statements
+
+def relations(conn=conn):
+	c = conn.cursor()
+	c.execute("SELECT name FROM sqlite_master WHERE type='table'")
+	names = []
+	for row in c:
+		names += [row[0]]
+	c.close()
+	rels = []
+	for name in names:
+		if f"{name}cnn" in names:
+			rels += [(name, True)]
+		elif f"{name}cn" in names:
+			rels += [(name, False)]
+	return rels
+
+# Create the indexes for relations in databases created before the
+# indexes were introduced and drop the indexes of B values.
+def migrate_index():
+	statements = []
+	for (name, binary) in relations():
+		if name[-1:] == "B" and f"{name}_rt" in indexes:
+			for index in ["_rt", "_lrt", "_a1"]:
+				statements += [(f"DROP INDEX IF EXISTS {name}{index}", ())]
+		if f"{name}_lt" in indexes:
+			continue
+		if binary:
+			for index in ["cnn_r", "cn1_r", "c1n_l", "c11x_l", "c11x_r"]:
+				statements += [(f"DROP INDEX IF EXISTS {name}{index}", ())]
+			statements += binary_index(name)
+		else:
+			statements += unary_index(name)
+	return statements
+
+# The style (color and shape) of every role and entity is resolved into
+# the RoleStyle and EntityStyle tables by triggers on the current state
+# of the style relations and RoleES. An entity gets the average color of
+# its roles and the shape of its most recent role that has one.
+
+def entity_style(where):
+	return f"""INSERT INTO EntityStyle (e, red, green, blue, shape)
+		SELECT role.l, sum(style.red)/count(style.red), sum(style.green)/count(style.green), sum(style.blue)/count(style.blue),
+			(SELECT shape.shape FROM RoleEScnn shaperole JOIN RoleStyle shape ON (shape.role = shaperole.r)
+				WHERE shaperole.l = role.l AND shape.shape IS NOT NULL ORDER BY shaperole.t DESC LIMIT 1)
+		FROM RoleEScnn role JOIN RoleStyle style ON (style.role = role.r)
+		WHERE {where} GROUP BY role.l"""
+
+def role_style(role):
+	return f"""DELETE FROM RoleStyle WHERE role = {role};
+		INSERT INTO RoleStyle (role, red, green, blue, shape) SELECT {role},
+			(SELECT r FROM RedSIcn1 WHERE l = {role}), (SELECT r FROM GreenSIcn1 WHERE l = {role}),
+			(SELECT r FROM BlueSIcn1 WHERE l = {role}), (SELECT r FROM ShapeSScn1 WHERE l = {role});
+		DELETE FROM EntityStyle WHERE e IN (SELECT l FROM RoleEScnn WHERE r = {role});
+		{entity_style(f"role.l IN (SELECT l FROM RoleEScnn WHERE r = {role})")};"""
+
+def style_tables():
+	global tables
+	statements = []
+	if "EntityStyle" not in tables:
+		statements += [("CREATE TABLE IF NOT EXISTS RoleStyle (role TEXT PRIMARY KEY, red INTEGER, green INTEGER, blue INTEGER, shape TEXT)", ())]
+		statements += [(f"CREATE TABLE IF NOT EXISTS EntityStyle (e {dbtype['E']} PRIMARY KEY, red INTEGER, green INTEGER, blue INTEGER, shape TEXT)", ())]
+		for rel in ["RedSIcn1", "GreenSIcn1", "BlueSIcn1", "ShapeSScn1"]:
+			statements += [(f"CREATE TRIGGER IF NOT EXISTS {rel}_insert_style AFTER INSERT ON {rel} BEGIN {role_style('new.l')} END", ())]
+			statements += [(f"CREATE TRIGGER IF NOT EXISTS {rel}_delete_style AFTER DELETE ON {rel} BEGIN {role_style('old.l')} END", ())]
+		for (event, row) in [("INSERT", "new"), ("DELETE", "old")]:
+			statements += [(f"""CREATE TRIGGER IF NOT EXISTS RoleEScnn_{event.lower()}_style AFTER {event} ON RoleEScnn BEGIN
+				DELETE FROM EntityStyle WHERE e = {row}.l;
+				{entity_style(f"role.l = {row}.l")};
+				END""", ())]
+		# Populate from the current state when migrating an existing database
+		statements += [("""INSERT INTO RoleStyle (role, red, green, blue, shape) SELECT role.l,
+			(SELECT r FROM RedSIcn1 WHERE l = role.l), (SELECT r FROM GreenSIcn1 WHERE l = role.l),
+			(SELECT r FROM BlueSIcn1 WHERE l = role.l), (SELECT r FROM ShapeSScn1 WHERE l = role.l)
+			FROM (SELECT l FROM RedSIcn1 UNION SELECT l FROM GreenSIcn1 UNION SELECT l FROM BlueSIcn1 UNION SELECT l FROM ShapeSScn1) role""", ())]
+		statements += [(entity_style("1"), ())]
+		tables += ["RoleStyle", "EntityStyle"]
+	return statements
+
+###
+### Entity dictionary
+
+# Entities are identified by UUIDs outside of the database. Inside, the E
+# columns hold the integer id of the UUID in the Entity table, which keeps
+# the rows, indexes and joins small. Statements bind UUIDs and translate
+# them with entity_id and queries return UUIDs with entity_uuid().
+
+entity_id = "(SELECT id FROM Entity WHERE uuid = ?)"
+
+def entity_uuid(column):
+	return f"(SELECT uuid FROM Entity WHERE id = {column})"
+
+def entity_table():
+	return [("CREATE TABLE IF NOT EXISTS Entity (id INTEGER PRIMARY KEY, uuid TEXT UNIQUE)", ())]
+
+def entity_insert(uuid):
+	if uuid is None:
+		return []
+	return [("INSERT OR IGNORE INTO Entity (uuid) values (?)", (uuid, ))]
+
+# The columns of a relation and their designation letters
+def columns(name, binary):
+	if binary:
+		return [("l", name[-2:-1]), ("r", name[-1:])]
+	return [("l", name[-1:])]
+
+# Databases created before the entity dictionary have UUIDs in the E
+# columns. The relations with E columns are copied with ids instead and
+# their current state and the styles are built again. A relation is
+# renamed before its state tables are dropped, since renaming checks the
+# triggers and views that use them.
+def migrate_entities():
+	global tables
+	statements = []
+	if "Entity" in tables:
+		return statements
+	statements += entity_table()
+	rels = [(name, binary) for (name, binary) in relations() if "E" in [letter for (col, letter) in columns(name, binary)]]
+	for (name, binary) in rels:
+		for (col, letter) in columns(name, binary):
+			if letter == "E":
+				statements += [(f"INSERT OR IGNORE INTO Entity (uuid) SELECT {col} FROM {name} WHERE {col} IS NOT NULL ORDER BY t", ())]
+	for (name, binary) in rels:
+		defs = ", ".join(f"{col} {dbtype[letter]}" for (col, letter) in columns(name, binary))
+		names = ", ".join(col for (col, letter) in columns(name, binary))
+		values = ", ".join(f"(SELECT id FROM Entity WHERE uuid = {col})" if letter == "E" else col for (col, letter) in columns(name, binary))
+		statements += [(f"CREATE TABLE {name}_ids (t INTEGER PRIMARY KEY, {defs}, a INTEGER)", ())]
+		statements += [(f"INSERT INTO {name}_ids (t, {names}, a) SELECT t, {values}, a FROM {name}", ())]
+		statements += [(f"DROP TABLE {name}", ())]
+		statements += [(f"ALTER TABLE {name}_ids RENAME TO {name}", ())]
+		if binary:
+			statements += [(f"DROP VIEW IF EXISTS {name}c11", ())]
+			for card in ["cnn", "cn1", "c1n", "c11x"]:
+				statements += [(f"DROP TABLE IF EXISTS {name}{card}", ())]
+			statements += binary_state(name)
+			statements += binary_index(name)
+		else:
+			statements += [(f"DROP TABLE IF EXISTS {name}cn", ())]
+			statements += unary_state(name)
+			statements += unary_index(name)
+	if "EntityStyle" in tables:
+		statements += [("DROP TABLE EntityStyle", ())]
+		statements += [("DROP TABLE RoleStyle", ())]
+		tables = [name for name in tables if name not in ["EntityStyle", "RoleStyle"]]
+	tables += ["Entity"]
+	return statements
+
 ###
 ### Domain model definition
 
@@ -132,13 +439,21 @@ def relate(tuple_triplet, associate=True):
 	if len(tuple_triplet) == 2:
 		l = tuple_triplet[0]
 		rel = tuple_triplet[1]
-		statements += [(f"INSERT INTO {rel} (l, a) values (?, ?)", (l, a))]
-		statements += [(f"INSERT INTO RoleES (l, r, a) values (?, ?, ?)", (l, rel, a))]
+		statements += entity_insert(l)
+		statements += [(f"INSERT INTO {rel} (l, a) values ({entity_id}, ?)", (l, a))]
+		statements += [(f"INSERT INTO RoleES (l, r, a) values ({entity_id}, ?, ?)", (l, rel, a))]
 	elif len(tuple_triplet) == 3:
 		l = tuple_triplet[0]
 		rel = tuple_triplet[1]
 		r = tuple_triplet[2]
-		statements += [(f"INSERT INTO {rel} (l, r, a) values (?, ?, ?)", (l, r, a))]
+		(lvalue, rvalue) = ("?", "?")
+		if rel[-2:-1] == "E":
+			statements += entity_insert(l)
+			lvalue = entity_id
+		if rel[-1:] == "E":
+			statements += entity_insert(r)
+			rvalue = entity_id
+		statements += [(f"INSERT INTO {rel} (l, r, a) values ({lvalue}, {rvalue}, ?)", (l, r, a))]
 	else:
 		raise PiiError("Too few/many items: {tuple_triplet}")
 	return statements
@@ -146,14 +461,774 @@ def relate(tuple_triplet, associate=True):
 ###
 ### Database access
 
-def execute(statements):
+# Statements are written in explicit transactions. Rows inserted with the
+# same statement are grouped into one executemany() call and a transaction
+# is committed every batch_size rows. With the flush policy "call" the
+# transaction is also committed when execute() returns, with "batch" it is
+# kept open between calls until batch_size is reached or flush() is called.
+# The connection sees its own uncommitted rows, so lookups in between
+# calls to execute() still find them. A failing statement rolls back the
+# open transaction.
+
+batch_size = 10000
+flush_policy = "call"
+verbose = False
+pending = 0
+txid = None
+change_log = False
+
+# Every transaction that appends to a relation gets the next txid in Tx
+# with the wall clock time it was begun, once the log is created.
+# Transactions that append nothing leave no txid behind.
+def begin():
+	global txid
+	conn.execute("BEGIN")
+	if change_log:
+		txid = conn.execute("INSERT INTO Tx (time) values (?)", (datetime.datetime.now().isoformat(), )).lastrowid
+
+def groups(statements):
+	grouped = {}
 	for (s, v) in statements:
-		print(s, "<--", v)
-		conn.execute(s, v)
+		if s[:12] in ["INSERT INTO ", "INSERT OR IG"] and " values " in s:
+			if s not in grouped:
+				grouped[s] = []
+			grouped[s] += [v]
+		else:
+			# Other statements may read or create what is written before them
+			for item in grouped.items():
+				yield item
+			grouped = {}
+			yield (s, [v])
+	for item in grouped.items():
+		yield item
+
+def execute(statements):
+	global pending
+	try:
+		for (s, vs) in groups(statements):
+			for i in range(0, len(vs), batch_size):
+				if not conn.in_transaction:
+					begin()
+				chunk = vs[i:i + batch_size]
+				if verbose:
+					print(s, "<--", len(chunk))
+				if len(chunk) == 1:
+					conn.execute(s, chunk[0])
+				else:
+					conn.executemany(s, chunk)
+				pending += len(chunk)
+				if pending >= batch_size:
+					flush()
+	except:
+		rollback()
+		raise
+	if flush_policy == "call":
+		flush()
+
+def flush():
+	global pending, txid
+	if conn.in_transaction:
+		if txid is not None:
+			conn.execute("DELETE FROM Tx WHERE txid = ? AND NOT EXISTS (SELECT 1 FROM Change WHERE txid = ?)", (txid, txid))
+		conn.execute("COMMIT")
+	pending = 0
+	txid = None
+
+# Discards the statements executed since the last flush
+def rollback():
+	global pending, txid
+	if conn.in_transaction:
+		conn.execute("ROLLBACK")
+	pending = 0
+	txid = None
 
 def close():
+	flush()
 	conn.close()
 
+###
+### Change log
+
+# The t of a relation only orders the rows of that relation. Every row
+# appended to any relation is also written to Change by a trigger, with
+# the txid of the transaction, so the changes between two points in time
+# are read from one index. Values of B relations are left out of the log,
+# they are read from the relation.
+
+def change_trigger(name, binary):
+	r = "new.r" if binary and name[-1:] != "B" else "NULL"
+	return [(f"""CREATE TRIGGER IF NOT EXISTS {name}_change AFTER INSERT ON {name} BEGIN
+		INSERT INTO Change (txid, relation, l, r, a) SELECT ifnull(max(txid), 0), '{name}', new.l, {r}, new.a FROM Tx;
+		END""", ())]
+
+# The history of a database created before the log was introduced has no
+# order between the relations. It is logged as one transaction.
+def change_tables():
+	global tables
+	statements = []
+	if "Change" in tables:
+		return statements
+	statements += [("CREATE TABLE IF NOT EXISTS Tx (txid INTEGER PRIMARY KEY, time TEXT)", ())]
+	statements += [("CREATE TABLE IF NOT EXISTS Change (txid INTEGER, relation TEXT, l, r, a INTEGER)", ())]
+	statements += [("CREATE INDEX IF NOT EXISTS Change_txid ON Change (txid)", ())]
+	statements += [("CREATE INDEX IF NOT EXISTS Tx_time ON Tx (time)", ())]
+	rels = relations()
+	if rels:
+		statements += [("INSERT INTO Tx (time) values (?)", (datetime.datetime.now().isoformat(), ))]
+	for (name, binary) in rels:
+		r = "r" if binary and name[-1:] != "B" else "NULL"
+		statements += [(f"INSERT INTO Change (txid, relation, l, r, a) SELECT (SELECT max(txid) FROM Tx), '{name}', l, {r}, a FROM {name} ORDER BY t", ())]
+		statements += change_trigger(name, binary)
+	tables += ["Tx", "Change"]
+	return statements
+
+# The last txid begun at or before the time, an ISO 8601 string
+def txid_at(when, conn=conn):
+	return conn.execute("select ifnull(max(txid), 0) from Tx where time <= ?", (when, )).fetchone()[0]
+
+# Yields (txid, time, relation, l, r, a) for the rows appended after txid
+# since up to and including txid until, in the order they were appended.
+# Entities are returned as UUIDs.
+def changes(since=0, until=None, conn=conn):
+	if until is None:
+		until = sys.maxsize
+	c = conn.cursor()
+	c.execute("""select change.txid, tx.time, change.relation, change.l, change.r, change.a, lentity.uuid, rentity.uuid
+		from Change change join Tx tx on (tx.txid = change.txid)
+		left join Entity lentity on (lentity.id = change.l)
+		left join Entity rentity on (rentity.id = change.r)
+		where change.txid > ? and change.txid <= ? order by change.txid, change.rowid""", (since, until))
+	try:
+		for (txid, when, rel, l, r, a, luuid, ruuid) in c:
+			rel = relation(rel)
+			if rel.left == "E":
+				l = luuid
+			if rel.right == "E":
+				r = ruuid
+			yield (txid, when, rel.name, l, r, a)
+	finally:
+		c.close()
+
+###
+### Relation lookups
+
+# A relation knows its name and the types of its columns from the
+# designation letters at the end of the name. Its current state is read
+# from the table of a cardinality (cn for unary relations, cnn, cn1, c1n
+# or c11 for binary relations).
+
+class Relation(collections.namedtuple("Relation", ["name", "left", "right"])):
+	def binary(self):
+		return self.right is not None
+
+	def state(self, card=None):
+		return f"{self.name}{card or ('cnn' if self.binary() else 'cn')}"
+
+	# The r of a row in a state table, which for B values is read from
+	# the relation by t
+	def value(self, alias):
+		if self.right == "B":
+			return f"(SELECT r FROM {self.name} WHERE t = {alias}.t)"
+		return f"{alias}.r"
+
+relation_objects = {}
+
+def relation(name):
+	if name not in relation_objects:
+		if name[-2:-1] in dbtype and name[-1:] in dbtype and len(name) > 2:
+			relation_objects[name] = Relation(name, name[-2:-1], name[-1:])
+		else:
+			relation_objects[name] = Relation(name, name[-1:], None)
+	return relation_objects[name]
+
+# A lookup finds the entities that have all the roles, whose latest value
+# (cn1) of each lvalue relation and latest l (c1n) of each rvalue relation
+# match and that are not the l of any missing relation. The SQL of a
+# lookup only depends on its shape, the relations involved, so it is
+# compiled once per shape and the values are bound as parameters. That
+# keeps the text stable for the prepared statement cache of the
+# connection.
+
+compiled = {}
+
+def lookup_sql(roles, lvalues=(), rvalues=(), missing=()):
+	shape = (tuple(roles), tuple(lvalues), tuple(rvalues), tuple(missing))
+	if shape not in compiled:
+		first = relation(roles[0]).state() if roles else relation(lvalues[0]).state("cn1")
+		sql = f"select distinct entity.uuid from {first} e join Entity entity on (entity.id = e.l)"
+		for (i, role) in enumerate(roles[1:]):
+			sql += f" join {relation(role).state()} role{i} on (role{i}.l = e.l)"
+		for (i, rel) in enumerate(lvalues):
+			value = entity_id if relation(rel).right == "E" else "?"
+			sql += f" join {relation(rel).state('cn1')} lvalue{i} on (lvalue{i}.l = e.l and {relation(rel).value(f'lvalue{i}')} = {value})"
+		for (i, rel) in enumerate(rvalues):
+			value = entity_id if relation(rel).left == "E" else "?"
+			sql += f" join {relation(rel).state('c1n')} rvalue{i} on (rvalue{i}.r = e.l and rvalue{i}.l = {value})"
+		for (i, rel) in enumerate(missing):
+			sql += f" {'where' if i == 0 else 'and'} not exists (select 1 from {relation(rel).state()} missing{i} where missing{i}.l = e.l)"
+		compiled[shape] = sql + " order by entity.uuid"
+	return compiled[shape]
+
+# lvalues and rvalues are lists of (relation, value)
+def lookup(conn, roles, lvalues=[], rvalues=[], missing=[]):
+	sql = lookup_sql(roles, [rel for (rel, v) in lvalues], [rel for (rel, v) in rvalues], missing)
+	c = conn.cursor()
+	c.execute(sql, [v for (rel, v) in lvalues] + [v for (rel, v) in rvalues])
+	found = [row[0] for row in c]
+	c.close()
+	return found
+
+# The other side of the current pairs of l (side "l") or r (side "r")
+def values(conn, rel, value, side="l", card=None):
+	shape = ("values", rel, side, card)
+	if shape not in compiled:
+		r = relation(rel)
+		(this, other) = (r.left, r.right) if side == "l" else (r.right, r.left)
+		param = entity_id if this == "E" else "?"
+		column = r.value("state") if side == "l" else "state.l"
+		result = entity_uuid(column) if other == "E" else column
+		compiled[shape] = f"select {result} from {r.state(card)} state where state.{side} = {param} order by state.t"
+	c = conn.cursor()
+	c.execute(compiled[shape], (value, ))
+	found = [row[0] for row in c]
+	c.close()
+	return found
+
+###
+### Role bitmaps
+
+# The entities of each role are kept as a compressed bitmap of their ids.
+# Like in roaring bitmaps the ids are split into containers of 65536 by
+# their high bits. A container with few ids is a sorted array of the low
+# 16 bits and a fuller one is the bits of a Python int, so intersection,
+# union and difference run a container at a time. The bitmaps follow the
+# rows appended to RoleES after the snapshot in RoleBitmap, which
+# save_role_bitmaps() replaces.
+
+bitmap_array_max = 4096
+
+def container_bits(c):
+	if isinstance(c, int):
+		return c
+	bits = 0
+	for low in c:
+		bits |= 1 << low
+	return bits
+
+def container_values(c):
+	if not isinstance(c, int):
+		return c
+	values = array.array("H")
+	digits = bin(c)[:1:-1]
+	low = digits.find("1")
+	while low >= 0:
+		values.append(low)
+		low = digits.find("1", low + 1)
+	return values
+
+# The smallest form of a container, None when it is empty
+def container_form(c):
+	if isinstance(c, int):
+		count = c.bit_count()
+		if count > bitmap_array_max:
+			return c
+		return container_values(c) if count > 0 else None
+	if len(c) > bitmap_array_max:
+		return container_bits(c)
+	return c if len(c) > 0 else None
+
+def container_op(a, b, op):
+	if isinstance(a, int) or isinstance(b, int):
+		(a, b) = (container_bits(a), container_bits(b))
+		return container_form(a & b if op == "and" else a | b if op == "or" else a & ~b)
+	(a, b) = (set(a), set(b))
+	return container_form(array.array("H", sorted(a & b if op == "and" else a | b if op == "or" else a - b)))
+
+class Bitmap:
+	def __init__(self, containers=None):
+		self.containers = containers if containers is not None else {}
+
+	def add(self, i):
+		(high, low) = (i >> 16, i & 0xFFFF)
+		c = self.containers.get(high)
+		if c is None:
+			self.containers[high] = array.array("H", [low])
+		elif isinstance(c, int):
+			self.containers[high] = c | (1 << low)
+		else:
+			pos = bisect.bisect_left(c, low)
+			if pos == len(c) or c[pos] != low:
+				c.insert(pos, low)
+				self.containers[high] = container_form(c)
+
+	def discard(self, i):
+		(high, low) = (i >> 16, i & 0xFFFF)
+		c = self.containers.get(high)
+		if c is None:
+			return
+		if isinstance(c, int):
+			c = container_form(c & ~(1 << low))
+		else:
+			pos = bisect.bisect_left(c, low)
+			if pos < len(c) and c[pos] == low:
+				del c[pos]
+			c = container_form(c)
+		if c is None:
+			del self.containers[high]
+		else:
+			self.containers[high] = c
+
+	def __contains__(self, i):
+		c = self.containers.get(i >> 16)
+		if c is None:
+			return False
+		if isinstance(c, int):
+			return (c >> (i & 0xFFFF)) & 1 == 1
+		pos = bisect.bisect_left(c, i & 0xFFFF)
+		return pos < len(c) and c[pos] == i & 0xFFFF
+
+	def __len__(self):
+		return sum(c.bit_count() if isinstance(c, int) else len(c) for c in self.containers.values())
+
+	def __iter__(self):
+		for high in sorted(self.containers):
+			for low in container_values(self.containers[high]):
+				yield (high << 16) | low
+
+	def op(self, other, op):
+		containers = {}
+		highs = self.containers.keys() & other.containers.keys() if op == "and" else self.containers.keys() | other.containers.keys() if op == "or" else self.containers.keys()
+		for high in highs:
+			(a, b) = (self.containers.get(high), other.containers.get(high))
+			c = a if b is None else b if a is None else container_op(a, b, op)
+			if c is not None:
+				containers[high] = c if isinstance(c, int) else array.array("H", c)
+		return Bitmap(containers)
+
+	def __and__(self, other):
+		return self.op(other, "and")
+
+	def __or__(self, other):
+		return self.op(other, "or")
+
+	def __sub__(self, other):
+		return self.op(other, "sub")
+
+def bitmap_tables():
+	statements = []
+	statements += [("CREATE TABLE IF NOT EXISTS RoleBitmap (role TEXT, high INTEGER, data BLOB, PRIMARY KEY (role, high)) WITHOUT ROWID", ())]
+	statements += [("CREATE TABLE IF NOT EXISTS RoleBitmapMark (t INTEGER)", ())]
+	return statements
+
+role_bitmaps = {}
+role_mark = None
+role_lock = threading.Lock()
+
+# Must be called with role_lock held
+def role_tick(conn):
+	global role_mark
+	if role_mark is None:
+		role_bitmaps.clear()
+		c = conn.cursor()
+		c.execute("select role, high, data from RoleBitmap")
+		for (role, high, data) in c:
+			if data[:1] == b"B":
+				role_bitmaps.setdefault(role, Bitmap()).containers[high] = int.from_bytes(data[1:], "little")
+			else:
+				role_bitmaps.setdefault(role, Bitmap()).containers[high] = array.array("H", data[1:])
+		c.close()
+		row = conn.execute("select max(t) from RoleBitmapMark").fetchone()
+		role_mark = row[0] or 0
+	c = conn.cursor()
+	c.execute("select t, l, r, a from RoleES where t > ? order by t", (role_mark, ))
+	for (t, l, r, a) in c:
+		if a == 1:
+			role_bitmaps.setdefault(r, Bitmap()).add(l)
+		elif r in role_bitmaps:
+			role_bitmaps[r].discard(l)
+		role_mark = t
+	c.close()
+
+# The entity ids of a role, (role_set("FileE") & role_set("MutableE")) -
+# role_set("ConstantE") for the files that are mutable and not constant
+def role_set(role, conn=conn):
+	with role_lock:
+		role_tick(conn)
+		found = role_bitmaps.get(role, Bitmap())
+		return Bitmap({high: c if isinstance(c, int) else array.array("H", c) for (high, c) in found.containers.items()})
+
+# The UUIDs of the entities in a bitmap
+def bitmap_entities(bitmap, conn=conn):
+	c = conn.cursor()
+	c.execute("select entity.uuid from json_each(?) e join Entity entity on (entity.id = e.value) order by entity.uuid", (jenc.encode(list(bitmap)), ))
+	found = [row[0] for row in c]
+	c.close()
+	return found
+
+# Replaces the snapshot with the current bitmaps
+def save_role_bitmaps(conn=conn):
+	with role_lock:
+		role_tick(conn)
+		statements = [("DELETE FROM RoleBitmap", ()), ("DELETE FROM RoleBitmapMark", ())]
+		for (role, bitmap) in role_bitmaps.items():
+			for (high, c) in bitmap.containers.items():
+				data = b"B" + c.to_bytes(8192, "little") if isinstance(c, int) else b"A" + c.tobytes()
+				statements += [("INSERT INTO RoleBitmap (role, high, data) values (?, ?, ?)", (role, high, data))]
+		statements += [("INSERT INTO RoleBitmapMark (t) values (?)", (role_mark, ))]
+	execute(statements)
+
+# Forgets the bitmaps after a rollback
+def reset_role_bitmaps():
+	global role_mark
+	with role_lock:
+		role_mark = None
+
+###
+### Blob store
+
+# With blob_store "files" content is kept in files under blob_dir instead
+# of in the database. The files are named after the SHA-256 of the
+# content, which is the ShaES of the constant, and the value related to
+# ContentEB is null. The files are compressed with blob_compression when
+# that makes them smaller. A compressed file starts with the length of
+# the content as 8 bytes big endian.
+#
+# With blob_store "chunks" content is split where a rolling hash of the
+# last bytes matches a pattern, so the chunks of content that is mostly
+# unchanged stay the same. Every chunk is stored once in Chunk and the
+# content is listed in ChunkList under its SHA-256.
+#
+# Files larger than blob_buffer_size are never read into memory as a
+# whole. They are copied to a staging file while they are hashed and
+# relate_file() stores them from there a buffer at a time. With
+# blob_store "files" the staging file is in blob_dir and is renamed to
+# the blob file. With "database" the value is allocated up front and
+# written incrementally, since the values of B relations are not indexed.
+
+blob_store = "database"
+blob_dir = "blobs"
+blob_compression = None
+blob_suffixes = {None: "", "zlib": ".zlib", "lzma": ".xz"}
+
+# Content is read in blocks of this many bytes
+blob_block_size = 64 * 1024
+# Files are stored a buffer of this many bytes at a time
+blob_buffer_size = 1024 * 1024
+
+chunk_min = 2 * 1024
+chunk_bits = 13 # 8 KiB on average
+chunk_max = 64 * 1024
+chunk_mask = ((1 << chunk_bits) - 1) << (64 - chunk_bits)
+# Fixed so that the same content is always split the same way
+chunk_gear = [random.Random(4747 + i).getrandbits(64) for i in range(256)]
+
+# Large content used to be kept in a Blob table instead of in ContentEB
+def blob_tables():
+	global tables
+	statements = []
+	if "Blob" in tables:
+		statements += [("""UPDATE ContentEB SET r = (SELECT blob.data FROM ShaEScn1 sha JOIN Blob blob ON (blob.sha = sha.r) WHERE sha.l = ContentEB.l)
+			WHERE r IS NULL AND l IN (SELECT sha.l FROM ShaEScn1 sha JOIN Blob blob ON (blob.sha = sha.r))""", ())]
+		statements += [("DROP TABLE Blob", ())]
+		tables = [name for name in tables if name != "Blob"]
+	statements += [("CREATE TABLE IF NOT EXISTS Chunk (id INTEGER PRIMARY KEY, sha TEXT UNIQUE, data BLOB)", ())]
+	statements += [("CREATE TABLE IF NOT EXISTS ChunkList (sha TEXT, offset INTEGER, size INTEGER, chunk INTEGER, PRIMARY KEY (sha, offset)) WITHOUT ROWID", ())]
+	return statements
+
+# Yields (start, end) of the chunks of data
+def chunk_bounds(data):
+	start = 0
+	while start < len(data):
+		end = min(start + chunk_max, len(data))
+		h = 0
+		for i in range(start + chunk_min, end):
+			h = ((h << 1) + chunk_gear[data[i]]) & 0xFFFFFFFFFFFFFFFF
+			if h & chunk_mask == 0:
+				end = i + 1
+				break
+		yield (start, end)
+		start = end
+
+def chunk_rows(sha, offset, chunk):
+	statements = []
+	csha = hashlib.sha256(chunk).hexdigest()
+	statements += [("INSERT OR IGNORE INTO Chunk (sha, data) values (?, ?)", (csha, sqlite3.Binary(chunk)))]
+	statements += [("INSERT OR IGNORE INTO ChunkList (sha, offset, size, chunk) values (?, ?, ?, (select id from Chunk where sha = ?))", (sha, offset, len(chunk), csha))]
+	return statements
+
+def chunk_statements(sha, data):
+	statements = []
+	for (start, end) in chunk_bounds(data) if len(data) > 0 else [(0, 0)]:
+		statements += chunk_rows(sha, start, data[start:end])
+	return statements
+
+# Splits the content of a file the same way as chunk_statements() does
+# with all of it. Chunks are found from where the previous one ended, so
+# the last chunk of a buffer is split again with the next buffer. The
+# chunks are stored under their own SHA-256 as they are found, the list
+# of chunks only when all of them are stored.
+def chunk_file(sha, path):
+	(offset, data) = (0, b"")
+	chunks = []
+	for block in file_blocks(path):
+		data += block
+		bounds = list(chunk_bounds(data))
+		statements = []
+		for (start, end) in bounds[:-1]:
+			(chunk, list_row) = chunk_rows(sha, offset + start, data[start:end])
+			statements += [chunk]
+			chunks += [list_row]
+		execute(statements)
+		offset += bounds[-1][0]
+		data = data[bounds[-1][0]:]
+	# The last chunk, or the empty chunk of empty content
+	(chunk, list_row) = chunk_rows(sha, offset, data)
+	execute([chunk] + chunks + [list_row])
+
+def blob_path(sha, compression=None):
+	return os.path.join(blob_dir, sha[:2], sha + blob_suffixes[compression])
+
+def blob_write(sha, data):
+	(compression, body) = (None, data)
+	if blob_compression:
+		packed = zlib.compress(data) if blob_compression == "zlib" else lzma.compress(data)
+		if len(packed) + 8 < len(data):
+			(compression, body) = (blob_compression, len(data).to_bytes(8, "big") + packed)
+	path = blob_path(sha, compression)
+	if os.path.exists(path):
+		return
+	os.makedirs(os.path.dirname(path), exist_ok=True)
+	tmp = f"{path}.{os.getpid()}.tmp"
+	with open(tmp, "wb") as f:
+		f.write(body)
+	os.replace(tmp, path)
+
+# Yields at most size bytes of a file object a buffer at a time
+def stream_blocks(f, size=None):
+	while size is None or size > 0:
+		block = f.read(blob_buffer_size if size is None else min(blob_buffer_size, size))
+		if not block:
+			return
+		if size is not None:
+			size -= len(block)
+		yield block
+
+def file_blocks(path, size=None):
+	with open(path, "rb") as f:
+		yield from stream_blocks(f, size)
+
+# Returns the path of a new staging file. With blob_store "files" it is
+# in blob_dir, so that it can be renamed to the blob file.
+def stage_path():
+	directory = None
+	if blob_store == "files":
+		directory = blob_dir
+		os.makedirs(directory, exist_ok=True)
+	(fd, path) = tempfile.mkstemp(".tmp", dir=directory)
+	os.close(fd)
+	return path
+
+# Yields the blocks while they are copied to the staging file. With
+# blob_store "files" and blob_compression they are also compressed in the
+# same pass to the staging file with the suffix of the compression, which
+# starts with the length of the content like in blob_write().
+def staged_blocks(blocks, stage):
+	compressed = None
+	if blob_store == "files" and blob_compression:
+		compressed = open(stage + blob_suffixes[blob_compression], "wb")
+	try:
+		with open(stage, "wb") as f:
+			c = None
+			if compressed:
+				compressed.write(bytes(8))
+				c = zlib.compressobj() if blob_compression == "zlib" else lzma.LZMACompressor()
+			size = 0
+			for block in blocks:
+				f.write(block)
+				if c:
+					compressed.write(c.compress(block))
+				size += len(block)
+				yield block
+			if c:
+				compressed.write(c.flush())
+				compressed.seek(0)
+				compressed.write(size.to_bytes(8, "big"))
+	finally:
+		if compressed:
+			compressed.close()
+
+# Returns the SHA-256 of the blocks and the staging file they are copied to
+def blob_stage(blocks):
+	stage = stage_path()
+	h = hashlib.sha256()
+	try:
+		for block in staged_blocks(blocks, stage):
+			h.update(block)
+	except:
+		blob_unstage(stage)
+		raise
+	return (h.hexdigest(), stage)
+
+def blob_unstage(stage):
+	for suffix in set(blob_suffixes.values()):
+		if os.path.exists(stage + suffix):
+			os.remove(stage + suffix)
+
+# Stores staged content in the blob files or in chunks and removes the
+# staging files. The compressed file is kept when it is the smaller one,
+# like in blob_write().
+def blob_put_file(sha, stage):
+	try:
+		if blob_store == "files":
+			compression = None
+			if blob_compression and os.path.getsize(stage + blob_suffixes[blob_compression]) < os.path.getsize(stage):
+				compression = blob_compression
+			if not any(os.path.exists(blob_path(sha, c)) for c in blob_suffixes):
+				os.makedirs(os.path.dirname(blob_path(sha)), exist_ok=True)
+				os.replace(stage + blob_suffixes[compression], blob_path(sha, compression))
+		elif blob_store == "chunks":
+			chunk_file(sha, stage)
+	finally:
+		blob_unstage(stage)
+
+# Relates l to content staged with staged_blocks(), which is not hashed
+# again since the staging file is only written once. In the database the
+# value is allocated with zeroblob() and written through blobopen() in
+# the open transaction.
+def relate_file(l, rel, sha, stage):
+	global pending
+	if blob_store != "database":
+		blob_put_file(sha, stage)
+		return relate([l, rel, None])
+	try:
+		if not conn.in_transaction:
+			begin()
+		for (s, v) in entity_insert(l):
+			conn.execute(s, v)
+		t = conn.execute(f"INSERT INTO {rel} (l, r, a) values ({entity_id}, zeroblob(?), 1)", (l, os.path.getsize(stage))).lastrowid
+		with conn.blobopen(rel, "r", t) as blob:
+			for block in file_blocks(stage):
+				blob.write(block)
+		pending += 1
+	except:
+		rollback()
+		raise
+	finally:
+		blob_unstage(stage)
+	return []
+
+# Returns the value to relate to ContentEB
+def blob_put(sha, data):
+	if blob_store == "files":
+		blob_write(sha, data)
+		return None
+	if blob_store == "chunks":
+		execute(chunk_statements(sha, data))
+		return None
+	return sqlite3.Binary(data)
+
+# Returns (where, kind) of the content. For files where is the path and
+# kind the compression, for chunks where is the SHA-256 and kind "chunks".
+def blob_find(sha, conn=conn):
+	for compression in blob_suffixes:
+		path = blob_path(sha, compression)
+		if os.path.exists(path):
+			return (path, compression)
+	if conn.execute("select 1 from ChunkList where sha = ? limit 1", (sha, )).fetchone():
+		return (sha, "chunks")
+	return None
+
+def blob_size(found, conn=conn):
+	(where, kind) = found
+	if kind == "chunks":
+		return conn.execute("select sum(size) from ChunkList where sha = ?", (where, )).fetchone()[0]
+	if kind is None:
+		return os.path.getsize(where)
+	with open(where, "rb") as f:
+		return int.from_bytes(f.read(8), "big")
+
+# Yields the content from start to end in blocks. Files are read through
+# mmap and chunks are read one at a time.
+def blob_blocks(found, start, end, conn=conn):
+	(path, compression) = found
+	if end <= start:
+		return
+	if compression == "chunks":
+		c = conn.cursor()
+		c.execute("""select list.offset, chunk.data from ChunkList list
+						join Chunk chunk on (chunk.id = list.chunk)
+						where list.sha = ? and list.offset + list.size > ? and list.offset < ?
+						order by list.offset""", (path, start, end))
+		for (offset, data) in c:
+			yield data[max(0, start - offset):end - offset]
+		c.close()
+		return
+	with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+		if compression is None:
+			for i in range(start, end, blob_block_size):
+				yield m[i:min(i + blob_block_size, end)]
+			return
+		d = zlib.decompressobj() if compression == "zlib" else lzma.LZMADecompressor()
+		pos = 0
+		for i in range(8, len(m), blob_block_size):
+			data = d.decompress(m[i:i + blob_block_size])
+			if pos + len(data) > start:
+				yield data[max(0, start - pos):end - pos]
+			pos += len(data)
+			if pos >= end:
+				return
+
+# Yields the content from start to end of a row in a relation
+def row_blocks(conn, rel, t, start, end):
+	with conn.blobopen(rel, "r", t, readonly=True) as blob:
+		blob.seek(start)
+		while start < end:
+			data = blob.read(min(blob_block_size, end - start))
+			if len(data) == 0:
+				break
+			yield data
+			start += len(data)
+
+# Returns the content related to e from the database or from the files
+def content(e, conn=conn, rel="ContentEB"):
+	c = conn.cursor()
+	c.execute(f"""select {relation(rel).value('content')}, sha.r from {rel}cn1 content
+					left join ShaEScn1 sha on (sha.l = content.l)
+					where content.l = {entity_id}""", (e, ))
+	row = c.fetchone()
+	c.close()
+	if not row:
+		return None
+	if row[0] is not None:
+		return row[0]
+	found = blob_find(row[1], conn) if row[1] else None
+	if not found:
+		return None
+	return b"".join(blob_blocks(found, 0, blob_size(found, conn), conn))
+
+# Moves the values of a relation to the blob_store through staging
+# files, so no value is read into memory as a whole. Only values that
+# match the ShaES of their entity are moved, since that is how they are
+# found.
+def externalize(rel="ContentEB"):
+	c = conn.cursor()
+	c.execute(f"""select content.t, length(content.r), sha.r from {rel} content
+					join ShaEScn1 sha on (sha.l = content.l)
+					where content.r is not null""")
+	rows = c.fetchall()
+	c.close()
+	moved = []
+	for (t, size, sha) in rows:
+		(staged, stage) = blob_stage(row_blocks(conn, rel, t, 0, size))
+		if staged == sha:
+			blob_put_file(sha, stage)
+			moved += [t]
+		else:
+			blob_unstage(stage)
+	execute([(f"UPDATE {rel} SET r = NULL WHERE t IN (select value from json_each(?))", (jenc.encode(moved), ))])
+	conn.execute("VACUUM")
+	return len(moved)
+
 ###
 ### Model Serialization
 
@@ -174,7 +1249,6 @@ def value2serial(t, v, rel, l):
 	return serial
 
 def cursor2serial(rel, c):
-	serial = ""
 	for row in c:
 		l = None
 		r = None
@@ -188,260 +1262,825 @@ def cursor2serial(rel, c):
 		elif len(row) > 2:
 			raise PiiError(f"Too many columns: {row}")
 
-		serial += value2serial(l, row[0], rel, row[0])
-		serial += f" -- {rel}"
 		if r:
-			serial += " -- "
-			serial += value2serial(r, row[1], rel, row[0])
-		serial += "\n"
-	return serial
+			yield f"{value2serial(l, row[0], rel, row[0])} -- {rel} -- {value2serial(r, row[1], rel, row[0])}\n"
+		else:
+			yield f"{value2serial(l, row[0], rel, row[0])} -- {rel}\n"
+
+# The serializers are generators that yield one line at a time so that
+# the lines can be sent while the remaining queries run. Join them when
+# the whole serialization is needed.
 
 def entity2serial(e, conn):
-	serial = ""
+	return entities2serial([e], conn)
 
+# The entities are passed to the queries as one JSON array parameter so
+# that the number of queries depends on the number of relations in the
+# model and not on the number of entities.
+
+def colors2serial(entities, conn, complete=False):
+	# Related entities are only colored when all components are defined
+	join = "and" if complete else "or"
 	c = conn.cursor()
-	c.execute("""select role.l, role.r from RoleEScnn role
-					where role.l = ?""", (e, ))
-	serial += cursor2serial("RoleES", c)
+	c.execute(f"""select e.value, printf("rgb(%d,%d,%d)", ifnull(style.red, 255), ifnull(style.green, 255), ifnull(style.blue, 255))
+					from json_each(?) e
+					join Entity entity on (entity.uuid = e.value)
+					join EntityStyle style on (style.e = entity.id)
+					where style.red is not null {join} style.green is not null {join} style.blue is not null""", (jenc.encode(entities), ))
+	yield from cursor2serial("ColorES", c)
 	c.close()
 
-	c = conn.cursor()
-	c.execute("""select coalesce(red.l, green.l, blue.l, "0"), printf("rgb(%d,%d,%d)", ifnull(red.r, 255), ifnull(green.r, 255), ifnull(blue.r, 255))
-					from
-						(select role.l as l, sum(red.r)/count(red.r) as r
-							from RoleEScnn role
-							join RedSIcn1 red on (role.r = red.l)
-							where role.l = ?) as red,
-						(select role.l as l, sum(green.r)/count(green.r) as r
-							from RoleEScnn role
-							join GreenSIcn1 green on (role.r = green.l)
-							where role.l = ?) as green,
-						(select role.l as l, sum(blue.r)/count(blue.r) as r
-							from RoleEScnn role
-							join BlueSIcn1 blue on (role.r = blue.l)
-							where role.l = ?) as blue""", (e, e, e))
-	serial += cursor2serial("ColorES", c)
-	c.close()		
+# Yields the lines of the relations on one side of the entities and adds
+# the entities found on the other side to related.
+def related2serial(entities, conn, side, related):
+	ids = jenc.encode(entities)
+	(this, other, model) = ("l", "r", "LeftSScnn") if side == "l" else ("r", "l", "RightSScnn")
 
+	# Find the relations each entity takes part in through its roles
 	c = conn.cursor()
-	c.execute("""select role.l, shape.r from ShapeSScn1 shape
-					join RoleEScnn role on (shape.l = role.r)
-					where role.l = ?""", (e, ))
-	serial += cursor2serial("ShapeES", c)
-	c.close()		
+	c.execute(f"""select distinct e.value, rel.{other} from json_each(?) e
+					join Entity entity on (entity.uuid = e.value)
+					join RoleEScnn role on (role.l = entity.id)
+					join {model} rel on (rel.{this} = role.r)""", (ids, ))
+	rels = {}
+	for row in c:
+		if row[1] not in rels:
+			rels[row[1]] = []
+		rels[row[1]] += [row[0]]
+	c.close()
+	if len(rels) == 0:
+		return
 
-	# Left relations
+	queries = []
+	data = []
+	# Sorted so that the same relations give the same statement text
+	for (rel, members) in sorted(rels.items()):
+		# The entities are on this side and E values on the other
+		letter = rel[-4:-3] if side == "l" else rel[-5:-4]
+		# B values are shown as links to the content
+		value = entity_uuid(f"rel.{other}") if letter == "E" else "NULL" if letter == "B" else f"rel.{other}"
+		(lvalue, rvalue) = ("e.value", value) if side == "l" else (value, "e.value")
+		queries += [f"select ?, {lvalue}, {rvalue} from json_each(?) e join Entity entity on (entity.uuid = e.value) join {rel} rel on (rel.{this} = entity.id)"]
+		data += [rel, jenc.encode(members)]
 	c = conn.cursor()
-	c.execute("""select lft.r from RoleEScnn role
-					join LeftSScnn lft on (lft.l = role.r)
-					where role.l = ?""", (e, ))
-	rels = []
+	c.execute(" union all ".join(queries), data)
 	for row in c:
-		rels += [row[0]]
+		rel = row[0]
+		yield from cursor2serial(rel[:-3], [row[1:]])
+		# Only entities have label, identity and color
+		if side == "r" or rel[-4:-3] == "E":
+			related.append(row[2] if side == "l" else row[1])
 	c.close()
 
-	for rel in rels:
-		# Find the relations the entity is part of
-		c = conn.cursor()
-		c.execute(f"""select rel.l, rel.r from {rel} rel
-						where rel.l = ?""", (e, ))
-		serial += cursor2serial(rel[:-3], c)
-		c.close()		
+def entities2serial(entities, conn):
+	entities = list(dict.fromkeys(entities))
+	ids = jenc.encode(entities)
+
+	c = conn.cursor()
+	c.execute("""select e.value, role.r from json_each(?) e
+					join Entity entity on (entity.uuid = e.value)
+					join RoleEScnn role on (role.l = entity.id)""", (ids, ))
+	yield from cursor2serial("RoleES", c)
+	c.close()
+
+	yield from colors2serial(entities, conn)
 
-		if rel[-4:-3] == "E":
-			# Find the label of related entities
+	c = conn.cursor()
+	c.execute("""select e.value, style.shape from json_each(?) e
+					join Entity entity on (entity.uuid = e.value)
+					join EntityStyle style on (style.e = entity.id)
+					where style.shape is not null""", (ids, ))
+	yield from cursor2serial("ShapeES", c)
+	c.close()
+
+	# Left and right relations
+	related = []
+	yield from related2serial(entities, conn, "l", related)
+	yield from related2serial(entities, conn, "r", related)
+
+	# Label, identity and color of related entities
+	related = list(dict.fromkeys(related))
+	if len(related) > 0:
+		nids = jenc.encode(related)
+		for rel in ["LabelES", "IdentityES"]:
 			c = conn.cursor()
-			c.execute(f"""select rel.r, id.r from {rel} rel
-							join LabelEScnn id on (rel.r = id.l)
-							where rel.l = ?""", (e, ))
-			serial += cursor2serial("LabelES", c)
+			c.execute(f"""select n.value, id.r from json_each(?) n
+							join Entity entity on (entity.uuid = n.value)
+							join {rel}cnn id on (id.l = entity.id)""", (nids, ))
+			yield from cursor2serial(rel, c)
 			c.close()
+		yield from colors2serial(related, conn, complete=True)
 
-			# Find the identity of related entities
-			c = conn.cursor()
-			c.execute(f"""select rel.r, id.r from {rel} rel
-							join IdentityEScnn id on (rel.r = id.l)
-							where rel.l = ?""", (e, ))
-			serial += cursor2serial("IdentityES", c)
+# One line per change with the txid, the time and + when the row
+# associates or - when it disassociates in front of the relation line.
+def changes2serial(since, until, conn):
+	for (txid, when, rel, l, r, a) in changes(since, until, conn):
+		rel = relation(rel)
+		line = value2serial(rel.left, l, rel.name, l)
+		if rel.binary():
+			line += f" -- {rel.name} -- {value2serial(rel.right, r, rel.name, l)}"
+		else:
+			line += f" -- {rel.name}"
+		yield f"{txid} {jenc.encode(when)} {'+' if a else '-'} {line}\n"
+
+###
+### Serialization cache
+
+# Serialized entities are kept in memory in least recently used order
+# until cache_budget bytes are used. The database is append only, so an
+# entry stays valid until rows are appended that touch the entity or one
+# of the related entities it shows the label, identity and color of.
+# Commits are detected through pragma data_version on a connection of
+# its own and the appended rows are found from the last seen t of every
+# relation. Concurrent requests for the same entity wait for the one
+# request that serializes it.
+
+cache_budget = 64 * 1024 * 1024
+cache = collections.OrderedDict()
+cache_size = 0
+cache_related = {}
+cache_flights = {}
+cache_lock = threading.Lock()
+cache_conn = None
+cache_clock = None
+cache_marks = {}
+
+# Changes to these relations can affect any entity
+style_relations = ["ShapeSS", "RedSI", "GreenSI", "BlueSI", "LeftSS", "RightSS"]
+
+def cache_evict(e):
+	global cache_size
+	(serial, related, size) = cache.pop(e)
+	cache_size -= size
+	for r in related:
+		if r in cache_related:
+			cache_related[r].discard(e)
+
+def cache_clear():
+	global cache_size
+	cache.clear()
+	cache_related.clear()
+	cache_size = 0
+
+# Must be called with cache_lock held
+def cache_tick():
+	global cache_conn, cache_clock
+	if not cache_conn:
+		cache_conn = sqlite3.connect(dbfile, isolation_level=None, check_same_thread=False, cached_statements=cached_statements)
+	version = cache_conn.execute("pragma data_version").fetchone()[0]
+	if version == cache_clock:
+		return cache_clock
+	# Relations created after the first tick are read from the start
+	first = cache_clock is None
+	cache_clock = version
+	for (rel, binary) in relations(cache_conn):
+		mark = cache_marks.get(rel, None if first else 0)
+		c = cache_conn.cursor()
+		if mark is None:
+			c.execute(f"select ifnull(max(t), 0) from {rel}")
+			cache_marks[rel] = c.fetchone()[0]
 			c.close()
+			continue
+		values = ", ".join(entity_uuid(col) if letter == "E" else col for (col, letter) in columns(rel, binary))
+		c.execute(f"select t, {values} from {rel} where t > ?", (mark, ))
+		for row in c:
+			cache_marks[rel] = row[0]
+			if rel in style_relations:
+				cache_clear()
+				continue
+			for e in row[1:]:
+				for key in list(cache_related.pop(e, [])):
+					if key in cache:
+						cache_evict(key)
+		c.close()
+	return cache_clock
 
-			c = conn.cursor()
-			c.execute(f"""select coalesce(red.l, green.l, blue.l, "0"), printf("rgb(%d,%d,%d)", ifnull(red.r, 255), ifnull(green.r, 255), ifnull(blue.r, 255))
-							from
-								(select rel.r as l, sum(red.r)/count(red.r) as r
-									from RoleEScnn role
-									join RedSIcn1 red on (role.r = red.l)
-									join {rel} rel on (role.l = rel.r)
-									where rel.l = ?
-									group by rel.r) as red,
-								(select rel.r as l, sum(green.r)/count(green.r) as r
-									from RoleEScnn role
-									join GreenSIcn1 green on (role.r = green.l)
-									join {rel} rel on (role.l = rel.r)
-									where rel.l = ?
-									group by rel.r) as green,
-								(select rel.r as l, sum(blue.r)/count(blue.r) as r
-									from RoleEScnn role
-									join BlueSIcn1 blue on (role.r = blue.l)
-									join {rel} rel on (role.l = rel.r)
-									where rel.l = ?
-									group by rel.r) as blue
-								where red.l = green.l and green.l = blue.l""", (e, e, e))
-			serial += cursor2serial("ColorES", c)
-			c.close()		
-
-#			c = conn.cursor()
-#			c.execute(f"""select rel.r, shape.r from ShapeSScn1 shape
-#							join RoleEScnn role on (shape.l = role.r)
-#							join {rel} rel on (role.l = rel.r)
-#							where rel.l = ?""", (e, ))
-#			serial += cursor2serial("ShapeES", c)
-#			c.close()		
-
-	# Right relations
+# Grows with every row appended to any relation
+def write_clock():
+	with cache_lock:
+		cache_tick()
+		return sum(cache_marks.values())
+
+def cached_entity2serial(e, conn):
+	global cache_size
+	while True:
+		with cache_lock:
+			clock = cache_tick()
+			if e in cache:
+				cache.move_to_end(e)
+				return cache[e][0]
+			flight = cache_flights.get(e)
+			if not flight:
+				flight = threading.Event()
+				cache_flights[e] = flight
+				break
+		flight.wait()
+	try:
+		serial = "".join(entity2serial(e, conn))
+		# The entity itself and every entity mentioned in the lines
+		related = set([e])
+		for line in serial.split("\n"):
+			parts = line.split(" -- ")
+			if len(parts) == 3:
+				related.add(parts[0])
+				if parts[2][:1] != "\"":
+					related.add(parts[2])
+		with cache_lock:
+			# Don't keep what may have been serialized before a commit
+			size = len(serial.encode())
+			if cache_tick() == clock and size <= cache_budget:
+				cache[e] = (serial, related, size)
+				cache_size += size
+				for r in related:
+					if r not in cache_related:
+						cache_related[r] = set()
+					cache_related[r].add(e)
+				while cache_size > cache_budget:
+					cache_evict(next(iter(cache)))
+	finally:
+		with cache_lock:
+			del cache_flights[e]
+		flight.set()
+	return serial
+
+###
+### Index advisor
+
+# Records the select statements issued on a connection and reports the
+# ones where EXPLAIN QUERY PLAN still shows a scan or a temporary b-tree.
+
+advised = None
+
+def advise_trace(sql):
+	if sql.lstrip()[:6].lower() == "select":
+		# One sample per query shape
+		advised[re.sub(r"'(?:[^']|'')*'|\b\d+\b", "?", sql)] = sql
+
+def advise_start(conn):
+	global advised
+	advised = {}
+	conn.set_trace_callback(advise_trace)
+
+def advise_stop(conn):
+	conn.set_trace_callback(None)
+	report = []
+	for (shape, sql) in advised.items():
+		c = conn.cursor()
+		c.execute("EXPLAIN QUERY PLAN " + sql)
+		subqueries = []
+		for row in c:
+			detail = row[3]
+			if detail.split(" ")[0] in ["MATERIALIZE", "CO-ROUTINE"]:
+				# Scanning the result of a subquery is not a table scan
+				subqueries += [f"SCAN {detail.split(' ')[1]}"]
+			elif "VIRTUAL TABLE" in detail:
+				# Neither is scanning a list of values (json_each)
+				continue
+			elif detail[:5] == "SCAN " and detail not in subqueries or "TEMP B-TREE" in detail:
+				report += [(detail, shape)]
+		c.close()
+	return report
+
+def advise_entities(conn, limit=100):
 	c = conn.cursor()
-	c.execute("""select rght.l from RoleEScnn role
-					join RightSScnn rght on (rght.r = role.r)
-					where role.l = ?""", (e, ))
-	rels = []
+	c.execute(f"select {entity_uuid('l')} from RoleEScnn group by l limit ?", (limit, ))
+	entities = []
 	for row in c:
-		rels += [row[0]]
+		entities += [row[0]]
 	c.close()
+	advise_start(conn)
+	for e in entities:
+		for line in entity2serial(e, conn):
+			pass
+	return advise_stop(conn)
 
-	for rel in rels:
-		# Find the reverse relations the entity is part of
-		c = conn.cursor()
-		c.execute(f"""select rel.l, rel.r from {rel} rel
-						where rel.r = ?""", (e, ))
-		serial += cursor2serial(rel[:-3], c)
-		c.close()
+def print_advice(report):
+	for (detail, shape) in report:
+		print(detail, "<--", " ".join(shape.split()))
+	print(f"advise: {len(report)} scans")
 
-		# Find the label of related entities
-		c = conn.cursor()
-		c.execute(f"""select rel.l, id.r from {rel} rel
-						join LabelEScnn id on (rel.l = id.l)
-						where rel.r = ?""", (e, ))
-		serial += cursor2serial("LabelES", c)
-		c.close()
+###
+### Connection pool
 
-		# Find the identity of reverse related entities
-		c = conn.cursor()
-		c.execute(f"""select rel.l, id.r from {rel} rel
-						join IdentityEScnn id on (rel.l = id.l)
-						where rel.r = ?""", (e, ))
-		serial += cursor2serial("IdentityES", c)
-		c.close()
+# The web server threads take read only connections from a bounded pool.
+# A query that runs longer than query_timeout seconds is interrupted by
+# the progress handler. Only the time spent in SQLite counts, the time a
+# streamed response waits for the client extends the deadline.
 
-		c = conn.cursor()
-		c.execute(f"""select coalesce(red.l, green.l, blue.l, "0"), printf("rgb(%d,%d,%d)", ifnull(red.r, 255), ifnull(green.r, 255), ifnull(blue.r, 255))
-						from
-							(select rel.l as l, sum(red.r)/count(red.r) as r
-								from RoleEScnn role
-								join RedSIcn1 red on (role.r = red.l)
-								join {rel} rel on (role.l = rel.l)
-								where rel.r = ?
-								group by rel.l) as red,
-							(select rel.l as l, sum(green.r)/count(green.r) as r
-								from RoleEScnn role
-								join GreenSIcn1 green on (role.r = green.l)
-								join {rel} rel on (role.l = rel.l)
-								where rel.r = ?
-								group by rel.l) as green,
-							(select rel.l as l, sum(blue.r)/count(blue.r) as r
-								from RoleEScnn role
-								join BlueSIcn1 blue on (role.r = blue.l)
-								join {rel} rel on (role.l = rel.l)
-								where rel.r = ?
-								group by rel.l) as blue
-							where red.l = green.l and green.l = blue.l""", (e, e, e))
-		serial += cursor2serial("ColorES", c)
-		c.close()		
-
-#		c = conn.cursor()
-#		c.execute(f"""select rel.l, shape.r from ShapeSScn1 shape
-#						join RoleEScnn role on (shape.l = role.r)
-#						join {rel} rel on (role.l = rel.l)
-#						where rel.r = ?""", (e, ))
-#		serial += cursor2serial("ShapeES", c)
-#		c.close()
-	return serial
+pool_size = 8
+pool_cache_size = -16 * 1024 # KiB per connection
+pool_mmap_size = 256 * 1024 * 1024
+query_timeout = 10.0
+pool = queue.LifoQueue()
+pool_count = 0
+pool_lock = threading.Lock()
+
+class PoolConnection(sqlite3.Connection):
+	deadline = 0
+
+	def extend(self, seconds):
+		self.deadline += seconds
+
+def pool_connect():
+	pconn = sqlite3.connect(f"file:{dbfile}?mode=ro", uri=True, isolation_level=None, check_same_thread=False, cached_statements=cached_statements, factory=PoolConnection)
+	pconn.execute(f"pragma cache_size={pool_cache_size}")
+	pconn.execute(f"pragma mmap_size={pool_mmap_size}")
+	pconn.execute("pragma query_only=1")
+	# Every statement gets its own deadline
+	def start(sql):
+		pconn.deadline = time.monotonic() + query_timeout
+	def progress():
+		return time.monotonic() > pconn.deadline
+	pconn.set_trace_callback(start)
+	pconn.set_progress_handler(progress, 10000)
+	return pconn
+
+def pool_get():
+	global pool_count
+	with pool_lock:
+		if pool.empty() and pool_count < pool_size:
+			pool_count += 1
+			return pool_connect()
+	return pool.get()
+
+def pool_put(pconn):
+	pool.put(pconn)
+
+def pool_close():
+	global pool_count
+	with pool_lock:
+		while not pool.empty():
+			pool.get().close()
+			pool_count -= 1
 
 ###
 ### Web application
 
 memfiles = None
 
+# Lines are collected into chunks of about this many bytes
+chunk_size = 16 * 1024
+
+# Idle persistent connections are closed after this many seconds
+keepalive_timeout = 60
+
+# Static files and memfiles are compressed once when the server starts.
+# Other responses are compressed when they are at least
+# compress_threshold bytes. Browsers revalidate every response with the
+# ETag, which for database responses is the write clock of the database
+# and the start time of the server.
+
+static_files = ["vis-network.min.js", "core.js"]
+static = {}
+compress_threshold = 1024
+compress_types = ["text/", "application/javascript", "application/json", "application/xml", "image/svg+xml"]
+web_started = None
+
+def compressible(contenttype):
+	return any(contenttype.startswith(t) for t in compress_types)
+
+def static_entry(contenttype, data, mtime):
+	etag = f'"{hashlib.sha256(data).hexdigest()[:32]}"'
+	gzdata = None
+	if compressible(contenttype):
+		gzdata = gzip.compress(data, mtime=0)
+		if len(gzdata) >= len(data):
+			gzdata = None
+	return (contenttype, data, gzdata, etag, mtime)
+
+def static_load():
+	static.clear()
+	for name in static_files:
+		if os.path.exists(name):
+			with open(name, "rb") as f:
+				data = f.read()
+			contenttype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+			static["/" + name] = static_entry(contenttype, data, os.stat(name).st_mtime)
+	for (path, (contenttype, content)) in memfiles.items():
+		if not callable(content):
+			static[path] = static_entry(contenttype, content.encode(), time.time())
+
+# Returns (start, end) of a single byte range, None when the header is to
+# be ignored and () when the range can't be satisfied.
+def byte_range(header, size):
+	m = re.fullmatch(r"bytes=(\d*)-(\d*)", header.strip())
+	if not m or m.group(1) == m.group(2) == "":
+		return None
+	if m.group(1) == "":
+		suffix = int(m.group(2))
+		return (max(0, size - suffix), size) if suffix > 0 else ()
+	start = int(m.group(1))
+	if m.group(2) != "" and int(m.group(2)) < start:
+		return None
+	end = size if m.group(2) == "" else min(size, int(m.group(2)) + 1)
+	return (start, end) if start < size else ()
+
 class HttpHandler(http.server.SimpleHTTPRequestHandler):
-	def do_GET(self):
-		global memfiles, webconn
+	protocol_version = "HTTP/1.1"
+	timeout = keepalive_timeout
+	# The pooled connection of the request in progress
+	pconn = None
+
+	# Requests in progress are counted so that shutdown can wait for them
+	def handle_one_request(self):
+		self.counted = False
+		try:
+			http.server.SimpleHTTPRequestHandler.handle_one_request(self)
+		finally:
+			if self.counted:
+				with self.server.active_lock:
+					self.server.active -= 1
+
+	def parse_request(self):
+		with self.server.active_lock:
+			self.server.active += 1
+		self.counted = True
+		ok = http.server.SimpleHTTPRequestHandler.parse_request(self)
+		if self.server.stopping:
+			self.close_connection = True
+		return ok
+
+	def accepts_gzip(self):
+		return "gzip" in self.headers.get("Accept-Encoding", "")
+
+	# Answers 304 when the client has what it asks for
+	def not_modified(self, etag, mtime=None):
+		match = self.headers.get("If-None-Match")
+		since = self.headers.get("If-Modified-Since")
+		if match is not None:
+			# Weak comparison
+			hit = match.strip() == "*" or etag.removeprefix("W/") in [m.strip().removeprefix("W/") for m in match.split(",")]
+		elif since is not None and mtime is not None:
+			try:
+				hit = int(mtime) <= email.utils.parsedate_to_datetime(since).timestamp()
+			except (TypeError, ValueError):
+				hit = False
+		else:
+			hit = False
+		if hit:
+			self.send_response(304)
+			self.send_header("ETag", etag)
+			self.end_headers()
+		return hit
+
+	def send_validators(self, etag, mtime=None):
+		if etag:
+			self.send_header("ETag", etag)
+			self.send_header("Cache-Control", "no-cache")
+		if mtime:
+			self.send_header("Last-Modified", self.date_time_string(mtime))
+		self.send_header("Vary", "Accept-Encoding")
+
+	def send_static(self, path):
+		(contenttype, data, gzdata, etag, mtime) = static[path]
+		if self.not_modified(etag, mtime):
+			return
+		self.send_response(200)
+		self.send_header("Content-Type", contenttype)
+		self.send_validators(etag, mtime)
+		if gzdata and self.accepts_gzip():
+			data = gzdata
+			self.send_header("Content-Encoding", "gzip")
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+	def next_chunk(self, lines):
+		chunk = []
+		size = 0
+		for line in lines:
+			chunk += [line.encode()]
+			size += len(chunk[-1])
+			if size >= chunk_size:
+				break
+		return b"".join(chunk)
+
+	def send_lines(self, lines, contenttype="text/plain; charset=UTF-8", etag=None):
+		lines = iter(lines)
+		# The first chunk is collected before the headers are sent. Errors
+		# in it still get an error response and small responses are sent
+		# whole.
+		chunk = self.next_chunk(lines)
+		if len(chunk) < chunk_size:
+			self.send_data(chunk, contenttype, etag)
+			return
+		compressor = zlib.compressobj(wbits=31) if self.accepts_gzip() else None
+		self.send_response(200)
+		self.send_header("Content-Type", contenttype)
+		self.send_validators(etag)
+		if compressor:
+			self.send_header("Content-Encoding", "gzip")
+		self.send_header("Transfer-Encoding", "chunked")
+		self.end_headers()
+		try:
+			while len(chunk) > 0:
+				if compressor:
+					# Flush every chunk so the client can parse what it has
+					chunk = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+				self.send_chunk(chunk)
+				chunk = self.next_chunk(lines)
+		except sqlite3.OperationalError as e:
+			# Leave out the last chunk so the client sees the response
+			# as incomplete
+			self.log_error("query failed: %s", e)
+			self.close_connection = True
+			return
+		if compressor:
+			self.send_chunk(compressor.flush())
+		# The last chunk is empty
+		self.send_chunk(b"")
+
+	def send_chunk(self, data):
+		self.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+
+	# The time spent waiting for the client is not counted against the
+	# query timeout of the pooled connection
+	def write(self, data):
+		start = time.monotonic()
+		self.wfile.write(data)
+		self.wfile.flush()
+		if self.pconn:
+			self.pconn.extend(time.monotonic() - start)
+
+	def send_data(self, data, contenttype, etag=None):
+		self.send_response(200)
+		self.send_header("Content-Type", contenttype)
+		self.send_validators(etag)
+		if len(data) >= compress_threshold and compressible(contenttype) and self.accepts_gzip():
+			data = gzip.compress(data, compresslevel=6, mtime=0)
+			self.send_header("Content-Encoding", "gzip")
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
 
-		if not webconn:
-			webconn = sqlite3.connect(dbfile, isolation_level=None)
+	def do_GET(self):
+		global memfiles
 
 		parts = self.path.split("/")
+		if self.path in static:
+			self.send_static(self.path)
+
+		elif parts[1] in ["entity", "content", "changes"] or self.path in memfiles.keys():
+			# Content has an ETag of its own
+			etag = None
+			if parts[1] != "content":
+				etag = f'W/"{web_started}-{write_clock()}"'
+				if self.not_modified(etag):
+					return
+			self.pconn = pconn = pool_get()
+			try:
+				self.get_pooled(parts, pconn, etag)
+			except sqlite3.OperationalError as e:
+				self.send_error(503, f"Query failed: {e}")
+			finally:
+				self.pconn = None
+				pool_put(pconn)
+		else:
+			http.server.SimpleHTTPRequestHandler.do_GET(self)
+
+	def get_pooled(self, parts, pconn, etag):
 		if parts[1] == "entity":
-			self.send_response(200)
-			self.send_header("Content-Type", "text/plain; charset=UTF-8")
-			self.end_headers()
-			print(entity2serial(parts[2], webconn))
-			self.wfile.write(entity2serial(parts[2], webconn).encode())
+			self.send_lines([cached_entity2serial(parts[2], pconn)], etag=etag)
 
 		elif parts[1] == "content":
-			c = webconn.cursor()
-			c.execute(f"""select contenttype.r, content.r
-							from ContentTypeEScn1 contenttype, {parts[3]}cn1 content
-							where content.l = contenttype.l and contenttype.l = ?""", (parts[2], ))
-			row = c.fetchone()
-			if row:
-				self.send_response(200)
-				self.send_header("Content-Type", row[0])
-				self.end_headers()
-				self.wfile.write(row[1])
-			c.close()
+			self.send_content(pconn, parts[2], parts[3])
 
-		elif self.path in memfiles.keys():
-			self.send_response(200)
-			self.send_header("Content-Type", memfiles[self.path][0])
+		elif parts[1] == "changes":
+			self.send_changes(pconn, parts[2:], etag)
+
+		else:
+			# A function is called with the connection and yields lines
+			(contenttype, content) = memfiles[self.path]
+			self.send_lines(content(pconn), contenttype, etag)
+
+	# /changes/since[/until] where the points in time are txids or ISO 8601
+	# times. A time stands for the last txid begun at or before it.
+	def send_changes(self, pconn, points, etag):
+		txids = []
+		for point in points[:2]:
+			point = urllib.parse.unquote(point)
+			if point.isdigit():
+				txids += [int(point)]
+			elif point:
+				try:
+					datetime.datetime.fromisoformat(point)
+				except ValueError:
+					self.send_error(400, f"Bad point in time: {point}")
+					return
+				txids += [txid_at(point, pconn)]
+		if not txids:
+			txids = [0]
+		self.send_lines(changes2serial(txids[0], txids[1] if len(txids) > 1 else None, pconn), etag=etag)
+
+	# The content is read with incremental BLOB I/O from the row in the
+	# relation that holds the current value, which never changes, or from
+	# the blob files.
+	def send_content(self, pconn, e, rel):
+		if not re.fullmatch(r"\w+B", rel):
+			self.send_error(404)
+			return
+		c = pconn.cursor()
+		c.execute(f"""select contenttype.r, content.t, length({relation(rel).value('content')}), sha.r
+						from ContentTypeEScn1 contenttype
+						join {rel}cn1 content on (content.l = contenttype.l)
+						left join ShaEScn1 sha on (sha.l = contenttype.l)
+						where contenttype.l = {entity_id}""", (e, ))
+		row = c.fetchone()
+		c.close()
+		# A null value is kept in the blob files
+		found = None
+		if row and row[2] is None and row[3]:
+			found = blob_find(row[3], pconn)
+		if not row or row[2] is None and not found:
+			self.send_error(404)
+			return
+		(contenttype, t, size, sha) = row
+		if found:
+			size = blob_size(found, pconn)
+			etag = f'"{sha}"'
+		else:
+			etag = f'"{rel}-{t}"'
+		if self.not_modified(etag):
+			return
+
+		(start, end) = (0, size)
+		ranged = None
+		if "Range" in self.headers and self.headers.get("If-Range", etag) == etag:
+			ranged = byte_range(self.headers["Range"], size)
+		if ranged == ():
+			self.send_response(416)
+			self.send_header("Content-Range", f"bytes */{size}")
+			self.send_header("Content-Length", "0")
 			self.end_headers()
-			self.wfile.write(memfiles[self.path][1].encode())
+			return
+		if ranged:
+			(start, end) = ranged
+			self.send_response(206)
+			self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+		else:
+			self.send_response(200)
+		self.send_header("Content-Type", contenttype)
+		self.send_header("Accept-Ranges", "bytes")
+		self.send_validators(etag)
+		self.send_header("Content-Length", str(end - start))
+		self.end_headers()
+		try:
+			if found:
+				blocks = blob_blocks(found, start, end, pconn)
+			else:
+				blocks = row_blocks(pconn, rel, t, start, end)
+			for data in blocks:
+				self.write(data)
+		except (sqlite3.Error, zlib.error, lzma.LZMAError) as e:
+			self.log_error("content failed: %s", e)
+			self.close_connection = True
+
+	# Expand many entities in one round trip. The body lists one entity
+	# per line.
+	def do_POST(self):
+		# Read the body even when it is not used to keep the connection
+		length = int(self.headers.get("Content-Length", 0))
+		body = self.rfile.read(length)
+
+		if self.path == "/entities":
+			entities = body.decode().split()
+			self.pconn = pconn = pool_get()
+			try:
+				self.send_lines(entities2serial(entities, pconn))
+			except sqlite3.OperationalError as e:
+				self.send_error(503, f"Query failed: {e}")
+			finally:
+				self.pconn = None
+				pool_put(pconn)
 
 		else:
-			http.server.SimpleHTTPRequestHandler.do_GET(self)
+			self.send_error(404)
 
-httpd = None
+class HttpServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+	daemon_threads = True
+	allow_reuse_address = True
+	active = 0
+	stopping = False
 
-def webserver(webport):
-	global httpd
+	def __init__(self, address, handler):
+		http.server.HTTPServer.__init__(self, address, handler)
+		self.active_lock = threading.Lock()
+
+###
+### Web server
+
+# serve() runs the web server until SIGINT (Ctrl-C) or SIGTERM. When
+# web_workers is more than one and fork is available, that many worker
+# processes accept connections on the same listening socket. Every worker
+# has its own connection pool and cache. SIGHUP starts new workers and
+# lets the old ones finish their requests, which for example makes the
+# workers see tables created after they started. At shutdown the requests
+# in progress get shutdown_grace seconds to finish.
+
+web_workers = 1
+shutdown_grace = 10.0
+
+httpd = None
 
-	httpd = socketserver.TCPServer(('', webport), HttpHandler)
+def web_run():
 	httpd.serve_forever()
+	deadline = time.monotonic() + shutdown_grace
+	while httpd.active > 0 and time.monotonic() < deadline:
+		time.sleep(0.1)
+	httpd.server_close()
+	pool_close()
+	print(f"webserver: closed ({os.getpid()})")
+
+def web_stop(signum=None, frame=None):
+	httpd.stopping = True
+	# shutdown() waits for serve_forever() and must run on another thread
+	threading.Thread(target=httpd.shutdown).start()
+
+def web_worker():
+	pid = os.fork()
+	if pid > 0:
+		return pid
+	try:
+		# The parent passes on SIGINT and SIGHUP as SIGTERM
+		signal.signal(signal.SIGINT, signal.SIG_IGN)
+		signal.signal(signal.SIGHUP, signal.SIG_IGN)
+		signal.signal(signal.SIGTERM, web_stop)
+		web_run()
+	finally:
+		# The connections inherited from the parent are not ours to close
+		os._exit(0)
+
+def prefork(workers):
+	events = []
+	def on_signal(signum, frame):
+		events.append(signum)
+	for signum in [signal.SIGINT, signal.SIGTERM, signal.SIGHUP]:
+		signal.signal(signum, on_signal)
+
+	children = set()
+	while True:
+		while len(children) < workers:
+			children.add(web_worker())
+		if len(events) > 0:
+			signum = events.pop(0)
+			old = children
+			if signum == signal.SIGHUP:
+				print("webserver: reloading")
+				children = set()
+				while len(children) < workers:
+					children.add(web_worker())
+			for pid in old:
+				os.kill(pid, signal.SIGTERM)
+			if signum != signal.SIGHUP:
+				break
+		(pid, status) = os.waitpid(-1, os.WNOHANG)
+		if pid == 0:
+			time.sleep(0.2)
+		elif pid in children:
+			# Replace workers that died
+			print(f"webserver: worker {pid} exited with {status}")
+			children.discard(pid)
+
+	print("webserver: stopping")
+	for pid in children:
+		os.waitpid(pid, 0)
 	httpd.server_close()
 	print("webserver: closed")
 
-def serve(webport, _memfiles, url):
-	global memfiles, httpd, wss_loop
+def serve(webport, _memfiles, url, workers=None):
+	global memfiles, httpd, web_started
 
 	memfiles = _memfiles
+	workers = workers or web_workers
+	web_started = int(time.time())
+	static_load()
 
-	web_thread = threading.Thread(target=webserver, args=(webport, ))
-	web_thread.start()
+	httpd = HttpServer(('', webport), HttpHandler)
 
 	print(f"url: {url}")
 	webbrowser.open(url)
 
-	input()
-	print("webserver: stopping")
-	# Break the wait for connection in the web server
-	conn = http.client.HTTPConnection("localhost", webport)
-	conn.request("GET", "/")
-	r = conn.getresponse()
-	print(r.status, r.reason)
-	httpd.shutdown()
+	if workers > 1 and hasattr(os, "fork"):
+		prefork(workers)
+	else:
+		signal.signal(signal.SIGINT, web_stop)
+		signal.signal(signal.SIGTERM, web_stop)
+		web_run()
 
 ###
 ### Pii initialization
 
 # Core schema
+# Reclaim the space of the UUIDs when the entity ids are introduced and
+# of the copies of B values when their state tables and indexes are
+# dropped
+vacuum = "Entity" not in tables and len(relations()) > 0
+vacuum = vacuum or any(name[-1:] == "B" and (f"{name}c1n" in tables or f"{name}_rt" in indexes) for name in tables)
+execute(migrate_state())
+execute(migrate_index())
+execute(migrate_entities())
+execute(change_tables())
+change_log = True
 execute(binary_rel("RoleES"))
 execute(binary_rel("ShapeSS"))
 execute(binary_rel("RedSI"))
@@ -449,6 +2088,18 @@ execute(binary_rel("GreenSI"))
 execute(binary_rel("BlueSI"))
 execute(binary_rel("LeftSS"))
 execute(binary_rel("RightSS"))
+execute(style_tables())
+execute(blob_tables())
+execute(bitmap_tables())
+if vacuum:
+	conn.execute("VACUUM")
 
 if __name__ == '__main__':
+	if "--advise" in sys.argv:
+		print_advice(advise_entities(conn))
+	if "--externalize" in sys.argv:
+		blob_store = "chunks" if "--chunks" in sys.argv else "files"
+		if "--compress" in sys.argv:
+			blob_compression = sys.argv[sys.argv.index("--compress") + 1]
+		print(f"externalize: {externalize()} values moved to {blob_store}")
 	conn.close()
@@ -24,6 +24,7 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 SOFTWARE.
 """
 
+import sys
 import core
 
 __author__ = "Marcus T. Andersson"
@@ -50,19 +51,23 @@ memfiles = {"/pii": ("text/html; charset=UTF-8", """
       &#128269; <input id="search" type="text" oninput="javascript:srch(document.getElementById('search').value);"/>
     </form>
     <div id="mynetwork" style="height:100%%;"></div>
-    <script> httpGetAsync('http://localhost:%d/query', parse_relations); </script>
+    <script> httpGetLines('http://localhost:%d/query', parse_relations); </script>
   </body>
 </html>
 """)}
 
-def serve(serial):
+# The query is a function that is called with a database connection for
+# every request and returns the lines to stream to the browser. Start
+# with --workers N to serve from N processes.
+def serve(query):
 	global memfiles
 
-	print(serial)
-
 	webport = 4747
+	workers = None
+	if "--workers" in sys.argv:
+		workers = int(sys.argv[sys.argv.index("--workers") + 1])
 
 	memfiles["/pii"] = (memfiles["/pii"][0], memfiles["/pii"][1] % webport)
-	memfiles["/query"] = ("text/plain; charset=UTF-8", serial)
+	memfiles["/query"] = ("text/plain; charset=UTF-8", query)
 
-	core.serve(webport, memfiles, f"http://localhost:{webport}/pii")
+	core.serve(webport, memfiles, f"http://localhost:{webport}/pii", workers)
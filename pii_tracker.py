@@ -38,44 +38,321 @@ import hashlib
 import datetime
 import os
 import uuid
-import sqlite3
+import sys
+import fnmatch
+import ast
+import re
+import multiprocessing
+import concurrent.futures
+import collections
+import subprocess
+import select
+import struct
+import time
+import ctypes
+import ctypes.util
 
 # This updates the version of changed files.
 import setversions
 
+###
+### File analysis
+
+# A file is read once. The content, its SHA-256 and the properties found
+# by the extractor for the type of file are kept until the file has been
+# tracked. Properties are cached by SHA-256 and extractor, so copies of a
+# file are only parsed once. The crawler analyzes files in advance in a pool.
+
+analyses = {}
+parsed = {}
+
+# Top level assignments to __name__ variables and imports
+def pythonExtractor(lines):
+	properties = {"imports": []}
+	for line in lines:
+		if line[0:7] == "import " or line[0:5] == "from ":
+			properties["imports"] += [line.split(" ")[1].rstrip()]
+		m = re.match(r"(__\w+__)\s*=(?!=)", line)
+		if m and m.group(1) not in properties:
+			try:
+				properties[m.group(1)] = ast.literal_eval(line.split("=", 1)[1].strip())
+			except (ValueError, SyntaxError):
+				properties[m.group(1)] = None
+	return properties
+
+# Tags in comment blocks, " * @version 1"
+def javascriptExtractor(lines):
+	properties = {}
+	for line in lines:
+		m = re.match(r" \* (@\w+)", line)
+		if m and m.group(1) not in properties:
+			properties[m.group(1)] = " ".join(line.split(" ")[3:]).strip()
+	return properties
+
+# "Name: value" lines and the first line with text as title
+def textExtractor(lines):
+	properties = {"title": None}
+	for line in lines:
+		m = re.match(r"(\w+): ", line)
+		if m and m.group(1) not in properties:
+			properties[m.group(1)] = "".join(line.split(" ")[1:]).strip()
+		if properties["title"] is None and len(line.strip()) > 0:
+			properties["title"] = line.strip()
+	return properties
+
+extractors = {".py": pythonExtractor, ".js": javascriptExtractor}
+
+# The stat is taken before the file is read, so a file saved while it is
+# read gets a stat that differs on the next run
+def analyze(path):
+	stat = statOf(path)
+	if stat[0] > core.blob_buffer_size:
+		return dict(analyzeLarge(path), stat=stat)
+	with open(path, "rb") as f:
+		content = f.read()
+	sha = hashlib.sha256(content).hexdigest()
+	extractor = extractors.get(os.path.splitext(path)[1], textExtractor)
+	if (sha, extractor) not in parsed:
+		parsed[(sha, extractor)] = extractor(content.decode("utf-8", errors="replace").splitlines())
+	return {"content": content, "sha": sha, "properties": parsed[(sha, extractor)], "stat": stat, "stage": None}
+
+# Files larger than core.blob_buffer_size are hashed, parsed and copied to
+# a staging file a buffer at a time in one pass. trackFile() stores them
+# from the staging file, so only the properties are kept. Only the first
+# buffer of a longer line is parsed.
+def analyzeLarge(path):
+	h = hashlib.sha256()
+	stage = core.stage_path()
+	def lines():
+		(rest, cut) = (b"", False)
+		for block in core.staged_blocks(core.file_blocks(path), stage):
+			h.update(block)
+			parts = (rest + block).split(b"\n")
+			rest = parts.pop()
+			for line in parts:
+				if not cut:
+					yield from line.decode("utf-8", errors="replace").splitlines()
+				cut = False
+			if len(rest) > core.blob_buffer_size:
+				if not cut:
+					yield from rest[:core.blob_buffer_size].decode("utf-8", errors="replace").splitlines()
+				(rest, cut) = (b"", True)
+		if not cut:
+			yield from rest.decode("utf-8", errors="replace").splitlines()
+	stream = lines()
+	extractor = extractors.get(os.path.splitext(path)[1], textExtractor)
+	try:
+		properties = extractor(stream)
+		# Hash and copy what the extractor did not read
+		for line in stream:
+			pass
+	except:
+		stream.close()
+		core.blob_unstage(stage)
+		raise
+	sha = h.hexdigest()
+	if (sha, extractor) not in parsed:
+		parsed[(sha, extractor)] = properties
+	return {"content": None, "sha": sha, "properties": parsed[(sha, extractor)], "stage": stage}
+
+def analysis(path):
+	if path not in analyses:
+		analyses[path] = analyze(path)
+	return analyses[path]
+
+# Removes the staging file of an analysis that was not stored
+def discard(path):
+	result = analyses.pop(path, None)
+	if result and result["stage"]:
+		core.blob_unstage(result["stage"])
+
+###
+### Session
+
+# The current state of the relations the tracker reads is kept in memory
+# for the run. A relation is loaded from its cnn table the first time it
+# is used and the rows created with relate() are added right away, so the
+# tracker functions see each other's rows before they are executed. The
+# time of a row orders the pairs of an l or r like t in the database.
+
+sessionRelations = {}
+sessionTime = 1 << 62
+
+def sessionRelation(rel):
+	if rel not in sessionRelations:
+		byL = {}
+		byR = {}
+		c = core.conn.cursor()
+		relation = core.relation(rel)
+		left = core.entity_uuid("state.l") if relation.left == "E" else "state.l"
+		right = core.entity_uuid("state.r") if relation.right == "E" else relation.value("state")
+		c.execute(f"select {left}, {right}, state.t from {relation.state()} state")
+		for (l, r, t) in c:
+			byL.setdefault(l, {})[r] = t
+			byR.setdefault(r, {})[l] = t
+		c.close()
+		sessionRelations[rel] = (byL, byR)
+	return sessionRelations[rel]
+
+# Values are compared as the column affinity stores them
+def sessionValue(letter, value):
+	# Entities are UUIDs outside of the database
+	if letter == "E":
+		return value
+	affinity = core.dbtype[letter]
+	if affinity == "TEXT" and isinstance(value, (int, float)):
+		return str(value)
+	if affinity in ["INTEGER", "REAL"] and isinstance(value, str):
+		try:
+			return int(value) if affinity == "INTEGER" else float(value)
+		except ValueError:
+			return value
+	return value
+
+def relate(tuple_triplet, associate=True):
+	global sessionTime
+	if len(tuple_triplet) == 2:
+		(l, rel, r) = (tuple_triplet[0], "RoleES", tuple_triplet[1])
+	else:
+		(l, rel, r) = tuple_triplet
+	(byL, byR) = sessionRelation(rel)
+	l = sessionValue(rel[-2:-1], l)
+	r = sessionValue(rel[-1:], r)
+	if associate:
+		sessionTime += 1
+		byL.setdefault(l, {})[r] = sessionTime
+		byR.setdefault(r, {})[l] = sessionTime
+	else:
+		byL.get(l, {}).pop(r, None)
+		byR.get(r, {}).pop(l, None)
+	return core.relate(tuple_triplet, associate)
+
+# The other sides of the current pairs of a value, as in the cnn table
+def related(rel, value, side="l"):
+	(byL, byR) = sessionRelation(rel)
+	if side == "l":
+		return byL.get(sessionValue(rel[-2:-1], value), {})
+	return byR.get(sessionValue(rel[-1:], value), {})
+
+# The latest pair of l, as in the cn1 table
+def latestR(rel, l):
+	pairs = related(rel, l, "l")
+	return max(pairs, key=pairs.get) if pairs else None
+
+# The latest pair of r, as in the c1n table
+def latestL(rel, r):
+	pairs = related(rel, r, "r")
+	return max(pairs, key=pairs.get) if pairs else None
+
+def hasPair(rel, l, r, card="cnn"):
+	if card == "cn1":
+		return latestR(rel, l) == sessionValue(rel[-1:], r)
+	if card == "c1n":
+		return latestL(rel, r) == sessionValue(rel[-2:-1], l)
+	return sessionValue(rel[-1:], r) in related(rel, l, "l")
+
+###
+### Content index
+
+# Constants are found by the SHA-256 and content type of their content in
+# ContentIndex, which is written with the statements that create the
+# constant. A Bloom filter of its keys is loaded at startup, so content
+# that is new is mostly found to be new without reading the database.
+# The filter is made twice as large when it holds the keys it was sized
+# for.
+
+bloomHashes = 7
+bloomBitsPerKey = 10
+bloom = bytearray()
+bloomCapacity = 0
+bloomKeys = 0
+createdConstants = {}
+
+# The constant is the id of its UUID in the Entity table, like in the
+# relations
+def contentIndexTable():
+	statements = []
+	fresh = "ContentIndex" not in core.tables
+	# The table used to hold the UUIDs of the constants
+	if not fresh and core.conn.execute("select type from pragma_table_info('ContentIndex') where name = 'constant'").fetchone()[0] == "TEXT":
+		statements += [("DROP TABLE ContentIndex", ())]
+		fresh = True
+	statements += [("CREATE TABLE IF NOT EXISTS ContentIndex (sha TEXT, contenttype TEXT, constant INTEGER, PRIMARY KEY (sha, contenttype)) WITHOUT ROWID", ())]
+	# Index the constants tracked before the table existed
+	if fresh:
+		statements += [("""INSERT OR IGNORE INTO ContentIndex (sha, contenttype, constant)
+			select sha.r, contenttype.r, min(constant.l) from ConstantEcn constant
+			join ShaEScn1 sha on (sha.l = constant.l)
+			join ContentTypeEScn1 contenttype on (contenttype.l = constant.l)
+			group by sha.r, contenttype.r""", ())]
+	return statements
+
+# The SHA-256 is already evenly spread, so the positions are taken from it
+def bloomPositions(sha, contenttype):
+	h1 = int(sha[:16], 16) ^ hash(contenttype)
+	h2 = int(sha[16:32], 16) | 1
+	return [(h1 + i * h2) % (len(bloom) * 8) for i in range(bloomHashes)]
+
+def bloomSet(sha, contenttype):
+	global bloomKeys
+	for p in bloomPositions(sha, contenttype):
+		bloom[p >> 3] |= 1 << (p & 7)
+	bloomKeys += 1
+
+def bloomHas(sha, contenttype):
+	return all(bloom[p >> 3] & (1 << (p & 7)) for p in bloomPositions(sha, contenttype))
+
+def loadContentIndex(capacity=0):
+	global bloom, bloomCapacity, bloomKeys
+	count = core.conn.execute("select count(*) from ContentIndex").fetchone()[0]
+	bloomCapacity = max(capacity, 2 * (count + len(createdConstants)), 1024)
+	bloom = bytearray(bloomCapacity * bloomBitsPerKey // 8)
+	bloomKeys = 0
+	c = core.conn.cursor()
+	c.execute("select sha, contenttype from ContentIndex")
+	for (sha, contenttype) in c:
+		bloomSet(sha, contenttype)
+	c.close()
+	for (sha, contenttype) in createdConstants:
+		bloomSet(sha, contenttype)
+
+def findConstant(sha, contenttype):
+	if not bloomHas(sha, contenttype):
+		return None
+	if (sha, contenttype) in createdConstants:
+		return createdConstants[(sha, contenttype)]
+	row = core.conn.execute(f"select {core.entity_uuid('constant')} from ContentIndex where sha = ? and contenttype = ?", (sha, contenttype)).fetchone()
+	return row[0] if row else None
+
+def indexConstant(sha, contenttype, constant):
+	if bloomKeys >= bloomCapacity:
+		loadContentIndex(2 * bloomCapacity)
+	createdConstants[(sha, contenttype)] = constant
+	bloomSet(sha, contenttype)
+	statements = core.entity_insert(constant)
+	statements += [(f"INSERT OR IGNORE INTO ContentIndex (sha, contenttype, constant) values (?, ?, {core.entity_id})", (sha, contenttype, constant))]
+	return statements
+
 ###
 ### Tracker functions
 
 def sha256sum(filename, value=False):
-    h  = hashlib.sha256()
-    if value:
-    	h.update(filename.encode())
-    else:
-	    b  = bytearray(128*1024)
-	    mv = memoryview(b)
-	    with open(filename, 'rb', buffering=0) as f:
-	        for n in iter(lambda : f.readinto(mv), 0):
-	            h.update(mv[:n])
-    return h.hexdigest()
+	if value:
+		return hashlib.sha256(filename.encode()).hexdigest()
+	return analysis(filename)["sha"]
 
 def findEntity(role, rel, value):
-	entity = None
-	c = core.conn.cursor()
-	c.execute(f"""select role.l from {role}cn role
-					join {rel} rel on (role.l = rel.l)
-					where rel.r = ?
-					limit 1""", (value, ))
-	for row in c:
-		entity = row[0]
-	c.close()
-	return entity
+	for l in sorted(related(rel, value, "r")):
+		if latestR(rel, l) == sessionValue(rel[-1:], value) and role in related("RoleES", l):
+			return l
+	return None
 
 def findArtifact(name):
-	return findEntity("ArtifactE", "IdentityEScn1", name)
+	return findEntity("ArtifactE", "IdentityES", name)
 
 def findSpecificationVersion(id):
 	c = core.conn.cursor()
-	c.execute("""select spec.l, version.l from SpecificationEcn spec
+	c.execute(f"""select {core.entity_uuid("spec.l")}, {core.entity_uuid("version.l")} from SpecificationEcn spec
 					join VersionEEc1n vrel on (spec.l = vrel.l)
 					join VersionEcn version on (version.l = vrel.r)
 					join IdentityEScnn id on (version.l = id.l)
@@ -90,26 +367,11 @@ def findSpecificationVersion(id):
 	return (spec, version)
 
 def getContent(constant):
-	content = None
-	c = core.conn.cursor()
-	c.execute(f"""select content.r from ContentEBcn1 content
-					where content.l = ?
-					limit 1""", (constant, ))
-	for row in c:
-		content = row[0]
-	c.close()
-	return content
+	return core.content(constant)
 
 def getCreationTime(constant):
-	mtime = None
-	c = core.conn.cursor()
-	c.execute(f"""select content.r from CreationTimeEScn1 content
-					where content.l = ?
-					limit 1""", (constant, ))
-	for row in c:
-		mtime = row[0]
-	c.close()
-	return mtime
+	mtimes = core.values(core.conn, "CreationTimeES", constant, card="cn1")
+	return mtimes[0] if mtimes else None
 
 def addRoles(entity, roles):
 	if not entity:
@@ -117,16 +379,9 @@ def addRoles(entity, roles):
 	statements = []
 	if isinstance(roles, str):
 		roles = [roles]
-	c = core.conn.cursor()
-	c.execute("""select role.r from RoleEScnn role 
-					where role.l = ?""", (entity, ))
-	existing = []
-	for row in c:
-		existing += [row[0]]
-	c.close()
 	for role in roles:
-		if not role in existing:
-			statements += core.relate([entity, role])
+		if not role in related("RoleES", entity):
+			statements += relate([entity, role])
 	return statements
 
 def link(l, rel, r, card="cnn"):
@@ -135,17 +390,8 @@ def link(l, rel, r, card="cnn"):
 	if not r:
 		raise PiiException("link(): r is null")
 	statements = []
-	c = core.conn.cursor()
-	c.execute(f"""select rel.l, rel.r from {rel}{card} rel 
-					where rel.l = ?
-					and rel.r = ?
-					limit 1""", (l, r))
-	lnk = None
-	for row in c:
-		lnk = row[0]
-	c.close()
-	if not lnk:
-		statements += core.relate([l, rel, r])
+	if not hasPair(rel, l, r, card):
+		statements += relate([l, rel, r])
 	return statements
 
 def weakLLink(l, rel, r, card="cnn"):
@@ -154,16 +400,8 @@ def weakLLink(l, rel, r, card="cnn"):
 	if not r:
 		raise PiiException("weakLLink(): r is null")
 	statements = []
-	c = core.conn.cursor()
-	c.execute(f"""select rel.l, rel.r from {rel}{card} rel 
-					where rel.l = ?
-					limit 1""", (l, ))
-	lnk = None
-	for row in c:
-		lnk = row[0]
-	c.close()
-	if not lnk:
-		statements += core.relate([l, rel, r])
+	if len(related(rel, l)) == 0:
+		statements += relate([l, rel, r])
 	return statements
 
 def trackFile(path, label, id, contenttype, mutable=None):
@@ -181,34 +419,32 @@ def trackFile(path, label, id, contenttype, mutable=None):
 
 	sha = sha256sum(path)
 
-	c = core.conn.cursor()
-	c.execute("""select constant.l from ConstantEcn constant
-					left join ShaEScn1 sha on (constant.l = sha.l)
-					left join ContentTypeEScn1 contenttype on (constant.l = contenttype.l)
-					where sha.r = ?
-					and contenttype.r = ?
-					limit 1""", (sha, contenttype))
-	constant = None
-	for row in c:
-		constant = row[0]
-	c.close()
+	constant = findConstant(sha, contenttype)
 	if not constant:
 		mtime = datetime.datetime.fromtimestamp(os.path.getmtime(path)).isoformat()
 		constant = str(uuid.uuid4())
-		statements += core.relate([constant, "EntityE"])
-		statements += core.relate([constant, "LabelES", mtime])
+		statements += indexConstant(sha, contenttype, constant)
+		statements += relate([constant, "EntityE"])
+		statements += relate([constant, "LabelES", mtime])
 		basename = os.path.basename(path)
-		statements += core.relate([constant, "IdentityES", f"{id} [in file] {basename} [at] {mtime}"])		
-		statements += core.relate([constant, "ConstantE"])
-		statements += core.relate([constant, "ShaES", sha])
-		statements += core.relate([constant, "ContentTypeES", contenttype])
-		statements += core.relate([constant, "CreationTimeES", mtime])
-		statements += core.relate([constant, "ContentEB", sqlite3.Binary(open(path, "rb").read())])
+		statements += relate([constant, "IdentityES", f"{id} [in file] {basename} [at] {mtime}"])		
+		statements += relate([constant, "ConstantE"])
+		statements += relate([constant, "ShaES", sha])
+		statements += relate([constant, "ContentTypeES", contenttype])
+		statements += relate([constant, "CreationTimeES", mtime])
+		statements += relateContent(constant, analysis(path))
 
 	statements += link(mutable, "ContentEE", constant)
 
 	return (statements, mutable, constant)
 
+# Content is never looked up, so it is not kept in the session. Large
+# content is stored from its staging file.
+def relateContent(constant, found):
+	if found["content"] is None:
+		return core.relate_file(constant, "ContentEB", found["sha"], found["stage"])
+	return core.relate([constant, "ContentEB", core.blob_put(found["sha"], found["content"])])
+
 def trackEmbedded(value, label, id, contenttype, mtime, mutable=None):
 	statements = []
 	if not mutable:
@@ -222,28 +458,19 @@ def trackEmbedded(value, label, id, contenttype, mtime, mutable=None):
 
 	sha = sha256sum(value, value=True)
 
-	c = core.conn.cursor()
-	c.execute("""select constant.l from ConstantEcn constant
-					left join ShaEScn1 sha on (constant.l = sha.l)
-					left join ContentTypeEScn1 contenttype on (constant.l = contenttype.l)
-					where sha.r = ?
-					and contenttype.r = ?
-					limit 1""", (sha, contenttype))
-	constant = None
-	for row in c:
-		constant = row[0]
-	c.close()
+	constant = findConstant(sha, contenttype)
 	if not constant:
 		constant = str(uuid.uuid4())
-		statements += core.relate([constant, "EntityE"])
-		statements += core.relate([constant, "LabelES", mtime])		
-		statements += core.relate([constant, "IdentityES", f"{id} [at] {mtime}"])		
-		statements += core.relate([constant, "ConstantE"])
-		statements += core.relate([constant, "ShaES", sha])
-		statements += core.relate([constant, "ContentTypeES", contenttype])
-		statements += core.relate([constant, "CreationTimeES", mtime])
-		statements += core.relate([constant, "ContentEB", sqlite3.Binary(value.encode())])
-		statements += core.relate([constant, "EmbeddedE"])
+		statements += indexConstant(sha, contenttype, constant)
+		statements += relate([constant, "EntityE"])
+		statements += relate([constant, "LabelES", mtime])		
+		statements += relate([constant, "IdentityES", f"{id} [at] {mtime}"])		
+		statements += relate([constant, "ConstantE"])
+		statements += relate([constant, "ShaES", sha])
+		statements += relate([constant, "ContentTypeES", contenttype])
+		statements += relate([constant, "CreationTimeES", mtime])
+		statements += core.relate([constant, "ContentEB", core.blob_put(sha, value.encode())])
+		statements += relate([constant, "EmbeddedE"])
 
 	statements += link(mutable, "ContentEE", constant)
 
@@ -251,37 +478,27 @@ def trackEmbedded(value, label, id, contenttype, mtime, mutable=None):
 
 def findOrCreate(roles, extra_roles, lvalues, extra_lvalues, rvalues, extra_rvalues):
 	statements = []
-	data = []
-	conditions = []
-	query = f"select role.l from {roles[0]}cn role "
-	for (i, role) in enumerate(roles[1:]):
-		query += f"join {role}cn role{i} on (role{i}.l = role.l) "
-	for (i, (rel, value)) in enumerate(lvalues):
-		query += f"join {rel}cn1 lvalue{i} on (lvalue{i}.l = role.l) "
-		conditions += [f"lvalue{i}.r = ? "]
-		data += [value]
-	for (i, (rel, value)) in enumerate(rvalues):
-		query += f"join {rel}c1n rvalue{i} on (rvalue{i}.r = role.l) "
-		conditions += [f"rvalue{i}.l = ? "]
-		data += [value]
-	for (i, condition) in enumerate(conditions):
-		query += "where " if i == 0 else "and "
-		query += condition
-	query += "limit 1"
-	c = core.conn.cursor()
-	c.execute(query, data)
-	found = None
-	for row in c:
-		found = row[0]
-	c.close()
+	# Entities whose latest lvalues and rvalues match and that have all
+	# the roles
+	candidates = None
+	for (rel, value) in lvalues:
+		matching = {e for e in related(rel, value, "r") if hasPair(rel, e, value, "cn1")}
+		candidates = matching if candidates is None else candidates & matching
+	for (rel, value) in rvalues:
+		matching = {e for e in related(rel, value, "l") if hasPair(rel, value, e, "c1n")}
+		candidates = matching if candidates is None else candidates & matching
+	if candidates is None:
+		candidates = set(related("RoleES", roles[0], "r"))
+	candidates = {e for e in candidates if all(role in related("RoleES", e) for role in roles)}
+	found = min(candidates) if candidates else None
 	if not found:
 		found = str(uuid.uuid4())
 		for role in roles:
-			statements += core.relate([found, role])
+			statements += relate([found, role])
 		for (rel, value) in lvalues:
-			statements += core.relate([found, rel, value])
+			statements += relate([found, rel, value])
 		for (rel, value) in rvalues:
-			statements += core.relate([value, rel, found])
+			statements += relate([value, rel, found])
 	statements += addRoles(found, extra_roles)
 	for (rel, value) in extra_lvalues:
 		statements += link(found, rel, value)
@@ -319,61 +536,11 @@ def trackEmbeddedRequirement(value, vnr, req, title, contentType, mtime):
 	statements += stmts
 	return (statements, artifact, mutable, constant)
 
-def trackGitVersions(path, label):
-	statements = []
-	artifact = findArtifact(label)
-	stream = os.popen(f"git log --date=iso-strict {path}")
-	log = stream.read().split("\n")
-	vnr = 0
-	lvalues = []
-	parsingComment = False
-	for line in log:
-		if parsingComment:
-			comment += line[4:] + "\n"
-		if line[0:len("commit ")] == "commit ":
-			vnr += 1
-			lvalues = [("CommitES", line.split(" ")[1])]
-		elif line[0:len("Date: ")] == "Date: ":
-			lvalues += [("DateET", " ".join(line.split(" ")[1:]).strip())]
-		elif line == "":
-			if parsingComment:
-				parsingComment = False
-				lvalues += [("CommentEB", comment.encode())]
-				(stmts, version) = findOrCreate(
-					["EntityE", "VersionE"],
-					["GitVersionE"],
-					[("VersionES", vnr)],
-					lvalues,
-					[("VersionEE", artifact)],
-					[])
-				statements += stmts
-				statements += weakLLink(version, "LabelES", f"v{vnr}")
-				statements += weakLLink(version, "IdentityES", f"{label} [git version] {vnr}")
-				statements += weakLLink(version, "ContentTypeES", f"text/plain; charset=UTF-8")
-			else:
-				comment = ""
-				parsingComment = True
-	return statements
-
 def pythonProperty(path, property):
-	with open(path) as f:
-		line = f.readline()
-		while line:
-			if line[0:len(property)] == property:
-				exec(line)
-				return locals()[property]
-			line = f.readline()
-	return None
+	return analysis(path)["properties"].get(property)
 
 def pythonImports(path):
-	imports = []
-	with open(path) as f:
-		line = f.readline()
-		while line:
-			if line[0:7] == "import " or line[0:5] == "from ":
-				imports += [line.split(" ")[1].rstrip()]
-			line = f.readline()
-	return imports
+	return analysis(path)["properties"]["imports"]
 
 def trackPythonFile(path):
 	vnr = pythonProperty(path, "__version__")
@@ -403,14 +570,7 @@ def trackPythonFile(path):
 	return statements
 
 def javascriptProperty(path, property):
-	property = " * " + property
-	with open(path) as f:
-		line = f.readline()
-		while line:
-			if line[0:len(property)] == property:
-				return " ".join(line.split(" ")[3:]).strip()
-			line = f.readline()
-	return None
+	return analysis(path)["properties"].get(property)
 
 def trackJavascriptFile(path):
 	vnr = javascriptProperty(path, "@version")
@@ -431,24 +591,10 @@ def trackJavascriptFile(path):
 	return statements
 
 def textProperty(path, property):
-	property = property + ": "
-	with open(path) as f:
-		line = f.readline()
-		while line:
-			if line[0:len(property)] == property:
-				return "".join(line.split(" ")[1:]).strip()
-			line = f.readline()
-	return None
+	return analysis(path)["properties"].get(property)
 
 def textTitle(path):
-	with open(path) as f:
-		line = f.readline()
-		while line:
-			line = line.strip()
-			if len(line)> 0:
-				return line
-			line = f.readline()
-	return path
+	return analysis(path)["properties"]["title"] or path
 
 def trackSpecification(path):
 	vnr = textProperty(path, "Version")
@@ -492,32 +638,477 @@ def trackRequirements(container_artifact, container_mutable, container_constant)
 
 	return statements
 
+###
+### Stat cache
+
+# A file is only tracked again when its size, mtime or inode differ from
+# when it was last tracked. A file with a new stat but the same SHA-256
+# only gets its stat updated. The stat is stored in the same transaction
+# as the statements from tracking the file.
+
+statCache = {}
+hashed = {}
+skipped = []
+touched = []
+changedFiles = []
+
+def statCacheTable():
+	return [("CREATE TABLE IF NOT EXISTS StatCache (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, sha TEXT)", ())]
+
+def loadStatCache():
+	c = core.conn.cursor()
+	c.execute("select path, size, mtime_ns, inode, sha from StatCache")
+	for row in c:
+		statCache[row[0]] = row[1:]
+	c.close()
+
+def storeStat(path):
+	statCache[path] = hashed[path]
+	return [("INSERT OR REPLACE INTO StatCache (path, size, mtime_ns, inode, sha) values (?, ?, ?, ?, ?)", (path, ) + hashed[path])]
+
+def statOf(path):
+	st = os.stat(path)
+	return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+def unchanged(path):
+	cached = statCache.get(path)
+	return cached is not None and cached[:3] == statOf(path)
+
+def changed(path):
+	if unchanged(path):
+		skipped.append(path)
+		return False
+	hashed[path] = analysis(path)["stat"] + (sha256sum(path), )
+	cached = statCache.get(path)
+	if cached and cached[3] == hashed[path][3]:
+		touched.append(path)
+		core.execute(storeStat(path))
+		return False
+	changedFiles.append(path)
+	return True
+
+def tracked(path):
+	return storeStat(path)
+
+def trackChanged(track, path):
+	try:
+		if not changed(path):
+			return []
+		return track(path) + tracked(path)
+	finally:
+		discard(path)
+
+def printStatReport():
+	print(f"stat cache: {len(changedFiles)} tracked, {len(skipped)} unchanged, {len(touched)} touched")
+	if core.verbose:
+		for path in skipped:
+			print(f"unchanged: {path}")
+		for path in touched:
+			print(f"touched: {path}")
+
+###
+### Crawler
+
+# Files under a directory are matched against include and exclude globs
+# and tracked by the first handler with a matching glob. The files of
+# earlier handlers are tracked first, since later ones link to them.
+# The files are analyzed in a pool of processes, or threads where fork is
+# not available, while all database access stays in this process.
+
+def trackSpecificationFile(path):
+	(statements, artifact, mutable, constant) = trackSpecification(path)
+	# The requirements are read from the tracked content
+	core.execute(statements)
+	return trackRequirements(artifact, mutable, constant)
+
+# (glob, track function, git label suffix)
+handlers = [
+	("requirements.txt", trackSpecificationFile, None),
+	("*.py", trackPythonFile, "/python"),
+	("*.js", trackJavascriptFile, "/javascript"),
+]
+
+def matches(root, path, include, exclude):
+	relpath = os.path.relpath(path, root)
+	return any(fnmatch.fnmatch(relpath, pattern) for pattern in include) and not any(fnmatch.fnmatch(relpath, pattern) for pattern in exclude)
+
+# Directories where every file is excluded are not crawled or watched
+def watched(root, path, exclude):
+	relpath = os.path.join(os.path.relpath(path, root), "*")
+	return not any(fnmatch.fnmatch(relpath, pattern) for pattern in exclude)
+
+def crawl(root, include, exclude):
+	for (dirpath, dirnames, filenames) in os.walk(root):
+		dirnames[:] = sorted(d for d in dirnames if watched(root, os.path.join(dirpath, d), exclude))
+		for name in sorted(filenames):
+			path = os.path.join(dirpath, name)
+			if matches(root, path, include, exclude):
+				yield path
+
+def handlerOf(path):
+	for (i, handler) in enumerate(handlers):
+		if fnmatch.fnmatch(os.path.basename(path), handler[0]):
+			return i
+	return None
+
+def extractionPool(workers):
+	# Forked processes don't run this script again
+	if "fork" in multiprocessing.get_all_start_methods():
+		return concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("fork"))
+	return concurrent.futures.ThreadPoolExecutor(workers)
+
+def trackTree(root, include, exclude, workers=None):
+	jobs = []
+	for path in crawl(root, include, exclude):
+		i = handlerOf(path)
+		if i is not None:
+			jobs += [(i, path)]
+	jobs.sort()
+	changedJobs = []
+	for (i, path) in jobs:
+		if unchanged(path):
+			skipped.append(path)
+		else:
+			changedJobs += [(i, path)]
+	# Only a few analyses are kept ahead of the writer, so the content
+	# waiting to be tracked doesn't grow with the size of the tree
+	ahead = collections.deque()
+	def trackNext():
+		(i, path, future) = ahead.popleft()
+		analyses[path] = future.result()
+		core.execute(trackChanged(handlers[i][1], path))
+	with extractionPool(workers) as pool:
+		for (i, path) in changedJobs:
+			ahead.append((i, path, pool.submit(analyze, path)))
+			if len(ahead) >= 2 * (workers or os.cpu_count() or 1):
+				trackNext()
+		while ahead:
+			trackNext()
+	return [path for (i, path) in jobs]
+
+###
+### Git history
+
+# The history of the whole repository is read with one git log, oldest
+# commit first. The last ingested commit and the number of commits that
+# changed each path are stored with the statements of each commit, so a
+# later run only reads the commits after it. A version is numbered by the
+# commits that changed the file, like setversions.py numbers the files,
+# which makes git version n the same entity as the tracked version n.
+# With contents the files of each version are read from one
+# git cat-file --batch process and get a ConstantE of their own.
+
+gitFields = "\x1f"
+gitRecords = "\x1e"
+
+def gitTables():
+	statements = []
+	statements += [("CREATE TABLE IF NOT EXISTS GitIngested (root TEXT PRIMARY KEY, head TEXT)", ())]
+	statements += [("CREATE TABLE IF NOT EXISTS GitVersions (root TEXT, path TEXT, versions INTEGER, PRIMARY KEY (root, path))", ())]
+	return statements
+
+def git(root, *args):
+	return subprocess.run(["git", "-C", root] + list(args), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL).stdout
+
+def gitIngested(root):
+	row = core.conn.execute("select head from GitIngested where root = ?", (root, )).fetchone()
+	head = row[0] if row else None
+	# History rewritten since the last run is read again from the start
+	if head and subprocess.run(["git", "-C", root, "merge-base", "--is-ancestor", head, "HEAD"], stderr=subprocess.DEVNULL).returncode != 0:
+		head = None
+	return head
+
+def gitVersions(root, head):
+	versions = {}
+	if head:
+		c = core.conn.cursor()
+		c.execute("select path, versions from GitVersions where root = ?", (root, ))
+		for row in c:
+			versions[row[0]] = row[1]
+		c.close()
+	return versions
+
+# (commit, date, comment, changed paths relative to root) after head
+def gitCommits(root, head=None):
+	log = git(root, "log", "--reverse", "--relative", "--date=iso-strict", "--name-only",
+		f"--format={gitRecords}%H{gitFields}%ad{gitFields}%B{gitFields}", f"{head}..HEAD" if head else "HEAD")
+	for record in log.decode("utf-8", errors="replace").split(gitRecords)[1:]:
+		(commit, date, comment, names) = record.split(gitFields)
+		yield (commit, date, comment, [name for name in names.split("\n") if name])
+
+# Reads the content of path at commit like analyze() reads a file, or
+# returns None when it was deleted. Content larger than
+# core.blob_buffer_size is copied to a staging file a buffer at a time.
+def gitContents(process, commit, path):
+	process.stdin.write(f"{commit}:{path}\n".encode())
+	process.stdin.flush()
+	header = process.stdout.readline().split()
+	if len(header) != 3 or header[1] != b"blob":
+		return None
+	size = int(header[2])
+	if size > core.blob_buffer_size:
+		(sha, stage) = core.blob_stage(core.stream_blocks(process.stdout, size))
+		found = {"content": None, "sha": sha, "stage": stage}
+	else:
+		data = process.stdout.read(size)
+		found = {"content": data, "sha": hashlib.sha256(data).hexdigest(), "stage": None}
+	process.stdout.read(1)
+	return found
+
+def trackGitContent(version, found, id, date, contenttype):
+	statements = []
+	sha = found["sha"]
+	constant = findConstant(sha, contenttype)
+	if found["stage"] and constant:
+		core.blob_unstage(found["stage"])
+	if not constant:
+		constant = str(uuid.uuid4())
+		statements += indexConstant(sha, contenttype, constant)
+		statements += relate([constant, "EntityE"])
+		statements += relate([constant, "LabelES", date])
+		statements += relate([constant, "IdentityES", f"{id} [at] {date}"])
+		statements += relate([constant, "ConstantE"])
+		statements += relate([constant, "ShaES", sha])
+		statements += relate([constant, "ContentTypeES", contenttype])
+		statements += relate([constant, "CreationTimeES", date])
+		statements += relateContent(constant, found)
+	statements += link(version, "ContentEE", constant)
+	return statements
+
+def trackGitVersion(label, vnr, commit, date, comment, found=None):
+	artifact = findArtifact(label)
+	(statements, version) = findOrCreate(
+		["EntityE", "VersionE"],
+		["GitVersionE"],
+		[("VersionES", vnr)],
+		[("CommitES", commit), ("DateET", date), ("CommentEB", comment.encode())],
+		[("VersionEE", artifact)],
+		[])
+	statements += weakLLink(version, "LabelES", f"v{vnr}")
+	statements += weakLLink(version, "IdentityES", f"{label} [git version] {vnr}")
+	statements += weakLLink(version, "ContentTypeES", f"text/plain; charset=UTF-8")
+	if found is not None:
+		statements += trackGitContent(version, found, f"{label} [git version] {vnr}", date, f"text/plain; charset=UTF-8")
+	return statements
+
+# Ingests the commits since the last run for the paths tracked by a
+# handler with a git label suffix
+def ingestGitHistory(root, paths, contents=False, full=False):
+	labels = {}
+	for path in paths:
+		suffix = handlers[handlerOf(path)][2]
+		if suffix:
+			labels[os.path.relpath(path, root)] = os.path.splitext(os.path.basename(path))[0] + suffix
+	key = os.path.realpath(root)
+	head = None if full else gitIngested(key)
+	versions = gitVersions(key, head)
+	if not head:
+		core.execute([("DELETE FROM GitVersions WHERE root = ?", (key, ))])
+	process = None
+	if contents:
+		process = subprocess.Popen(["git", "-C", root, "cat-file", "--batch"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+	ingested = 0
+	try:
+		for (commit, date, comment, names) in gitCommits(root, head):
+			statements = []
+			for name in names:
+				versions[name] = versions.get(name, 0) + 1
+				statements += [("INSERT OR REPLACE INTO GitVersions (root, path, versions) values (?, ?, ?)", (key, name, versions[name]))]
+				if name in labels:
+					found = gitContents(process, commit, name) if process else None
+					statements += trackGitVersion(labels[name], versions[name], commit, date, comment, found)
+			statements += [("INSERT OR REPLACE INTO GitIngested (root, head) values (?, ?)", (key, commit))]
+			core.execute(statements)
+			ingested += 1
+	finally:
+		if process:
+			process.stdin.close()
+			process.wait()
+	return ingested
+
+###
+### Watch
+
+# With --watch the tracker keeps running after the first run and tracks
+# the files that are saved. The directories are watched with inotify
+# where the C library has it and polled for stat changes otherwise (or
+# with --poll). Changes are collected until none has arrived for
+# watchDebounce seconds and the batch is committed in one transaction.
+# A file that fails to track is left out and the rest of the batch is
+# tracked again, since the failure rolled back the transaction.
+
+watchDebounce = 0.5
+watchInterval = 2.0
+
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+
+# Returns a function that waits at most timeout seconds (forever for
+# None) for changes and returns the paths changed, or None without inotify
+def inotifyEvents(root, include, exclude):
+	name = ctypes.util.find_library("c")
+	if not name:
+		return None
+	libc = ctypes.CDLL(name, use_errno=True)
+	if not hasattr(libc, "inotify_init1"):
+		return None
+	fd = libc.inotify_init1(os.O_CLOEXEC)
+	if fd < 0:
+		return None
+	dirs = {}
+	def add(top):
+		changed = set()
+		for (dirpath, dirnames, filenames) in os.walk(top):
+			dirnames[:] = [d for d in dirnames if watched(root, os.path.join(dirpath, d), exclude)]
+			wd = libc.inotify_add_watch(fd, os.fsencode(dirpath), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE)
+			if wd >= 0:
+				dirs[wd] = dirpath
+			# Files written before the watch was added
+			changed |= {os.path.join(dirpath, name) for name in filenames}
+		return changed
+	add(root)
+	def events(timeout):
+		changed = set()
+		if not select.select([fd], [], [], timeout)[0]:
+			return changed
+		data = os.read(fd, 64 * 1024)
+		offset = 0
+		while offset < len(data):
+			(wd, mask, cookie, length) = struct.unpack_from("iIII", data, offset)
+			name = os.fsdecode(data[offset + 16:offset + 16 + length].rstrip(b"\0"))
+			offset += 16 + length
+			if mask & IN_Q_OVERFLOW:
+				changed |= set(crawl(root, include, exclude))
+			elif mask & IN_IGNORED:
+				dirs.pop(wd, None)
+			elif wd in dirs:
+				path = os.path.join(dirs[wd], name)
+				if mask & IN_ISDIR:
+					if mask & (IN_CREATE | IN_MOVED_TO) and watched(root, path, exclude):
+						changed |= add(path)
+				elif mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+					changed.add(path)
+		return changed
+	return events
+
+def pollEvents(root, include, exclude):
+	seen = {}
+	def scan():
+		changed = set()
+		for path in crawl(root, include, exclude):
+			try:
+				st = statOf(path)
+			except OSError:
+				continue
+			if seen.get(path) != st:
+				seen[path] = st
+				changed.add(path)
+		return changed
+	scan()
+	def events(timeout):
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while True:
+			changed = scan()
+			if changed or (deadline is not None and time.monotonic() >= deadline):
+				return changed
+			time.sleep(watchInterval if deadline is None else max(0, min(watchInterval, deadline - time.monotonic())))
+	return events
+
+# Yields the changes that arrive within watchDebounce of each other
+def batches(events):
+	while True:
+		batch = set()
+		while not batch:
+			batch = events(None)
+		while True:
+			more = events(watchDebounce)
+			if not more:
+				break
+			batch |= more
+		yield batch
+
+def resetSession():
+	core.rollback()
+	sessionRelations.clear()
+	for path in list(analyses):
+		discard(path)
+	statCache.clear()
+	loadStatCache()
+	createdConstants.clear()
+	loadContentIndex()
+	core.reset_role_bitmaps()
+	del skipped[:], touched[:], changedFiles[:]
+
+def trackBatch(jobs):
+	for (n, (i, path)) in enumerate(jobs):
+		try:
+			core.execute(trackChanged(handlers[i][1], path))
+		except Exception as e:
+			print(f"failed: {path}: {e}")
+			resetSession()
+			return trackBatch(jobs[:n] + jobs[n + 1:])
+	core.flush()
+
+def watchTree(root, include, exclude, paths, history=False, poll=False):
+	events = None if poll else inotifyEvents(root, include, exclude)
+	if events is None:
+		events = pollEvents(root, include, exclude)
+	known = set(paths)
+	for batch in batches(events):
+		del skipped[:], touched[:], changedFiles[:]
+		parsed.clear()
+		jobs = []
+		for path in batch:
+			if os.path.isfile(path) and matches(root, path, include, exclude) and handlerOf(path) is not None:
+				jobs += [(handlerOf(path), path)]
+				known.add(path)
+		trackBatch(sorted(jobs))
+		commits = ingestGitHistory(root, sorted(known), history)
+		core.save_role_bitmaps()
+		core.flush()
+		printStatReport()
+		print(f"git history: {commits} commits ingested")
+
 ###
 ### Track Pii project
 
-(stmts, artifact, mutable, constant) = trackSpecification("./requirements.txt")
-core.execute(stmts)
-core.execute(trackRequirements(artifact, mutable, constant))
-
-core.execute(trackPythonFile("./core.py"))
-core.execute(trackPythonFile("./pii.py"))
-core.execute(trackPythonFile("./pii_model.py"))
-core.execute(trackPythonFile("./pii_tracker.py"))
-core.execute(trackPythonFile("./q_files.py"))
-core.execute(trackPythonFile("./q_spec.py"))
-core.execute(trackPythonFile("./q_no_implementation.py"))
-core.execute(trackPythonFile("./setversions.py"))
-core.execute(trackJavascriptFile("./core.js"))
-
-core.execute(trackGitVersions("./core.py", "core/python"))
-core.execute(trackGitVersions("./pii.py", "pii/python"))
-core.execute(trackGitVersions("./pii_model.py", "pii_model/python"))
-core.execute(trackGitVersions("./pii_tracker.py", "pii_tracker/python"))
-core.execute(trackGitVersions("./q_files.py", "q_files/python"))
-core.execute(trackGitVersions("./q_spec.py", "q_spec/python"))
-core.execute(trackGitVersions("./q_no_implementation.py", "q_no_implementation/python"))
-core.execute(trackGitVersions("./setversions.py", "setversions/python"))
-core.execute(trackGitVersions("./core.js", "core/javascript"))
+# Keep the transaction open between calls to core.execute() and commit
+# in batches
+core.flush_policy = "batch"
+core.verbose = "--verbose" in sys.argv
+if "--blobs" in sys.argv:
+	core.blob_store = "files"
+if "--chunks" in sys.argv:
+	core.blob_store = "chunks"
+if "--compress" in sys.argv:
+	core.blob_compression = sys.argv[sys.argv.index("--compress") + 1]
+
+# Report the tracker queries that still scan tables
+advise = "--advise" in sys.argv
+if advise:
+	core.advise_start(core.conn)
+
+# Skip the files that are unchanged since the last run, unless --full
+core.execute(statCacheTable())
+core.execute(gitTables())
+core.execute(contentIndexTable())
+loadContentIndex()
+if "--full" not in sys.argv:
+	loadStatCache()
+
+include = ["requirements.txt", "*.py", "*.js"]
+exclude = ["*.min.js", ".git/*", "*/__pycache__/*"]
+workers = None
+if "--workers" in sys.argv:
+	workers = int(sys.argv[sys.argv.index("--workers") + 1])
+
+paths = trackTree(".", include, exclude, workers)
+# Read the content of every version with --history
+commits = ingestGitHistory(".", paths, "--history" in sys.argv, "--full" in sys.argv)
 
 corepy = findArtifact("core/python")
 piipy = findArtifact("pii/python")
@@ -527,3 +1118,14 @@ core.execute(addRoles(piipy, ["ModuleE", "IntegratedE"]))
 core.execute(addRoles(corejs, ["ModuleE", "IntegratedE"]))
 core.execute(link(piipy, "ModuleEE", corejs))
 core.execute(link(corejs, "ModuleEE", piipy))
+core.save_role_bitmaps()
+core.flush()
+printStatReport()
+print(f"git history: {commits} commits ingested")
+
+if advise:
+	core.print_advice(core.advise_stop(core.conn))
+
+# Keep tracking the files that are saved
+if "--watch" in sys.argv:
+	watchTree(".", include, exclude, paths, "--history" in sys.argv, "--poll" in sys.argv)
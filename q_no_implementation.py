@@ -38,14 +38,8 @@ __implements__ = ["R5/v1"]
 import core
 import pii
 
-serial = ""
+def query(conn):
+	entities = core.lookup(conn, ["SpecificationE"], missing=["ImplementationEE"])
+	return core.entities2serial(entities, conn)
 
-c = core.conn.cursor()
-c.execute("""select spec.l from SpecificationEcn spec
-				left join ImplementationEEcnn impl on (impl.l = spec.l)
-				where impl.r is null""")
-for row in c:
-	serial += core.entity2serial(row[0], core.conn)
-c.close()
-
-pii.serve(serial)
+pii.serve(query)
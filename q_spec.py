@@ -36,13 +36,8 @@ __maintainer__ = "Marcus T. Andersson"
 import core
 import pii
 
-serial = ""
+def query(conn):
+	entities = core.bitmap_entities(core.role_set("SpecificationE", conn), conn)
+	return core.entities2serial(entities, conn)
 
-c = core.conn.cursor()
-c.execute("""select role.l from RoleEScnn role
-				where role.r = 'SpecificationE'""")
-for row in c:
-	serial += core.entity2serial(row[0], core.conn)
-c.close()
-
-pii.serve(serial)
+pii.serve(query)